@@ -1,24 +1,107 @@
+import cProfile
+import functools
+import json
+import os
+import time
+from urllib.parse import urlparse
+
 import pytest
 import logging
 import allure
 from selenium.webdriver import Chrome, ChromeOptions
 from webdriver_manager.chrome import ChromeDriverManager
 
+from screenshot_tests.utils.baseline_cache import BaselineStore
+from screenshot_tests.utils.driver_pool import DriverPool
+from screenshot_tests.utils.timing import timings
+
 
 class Config:
     BASE_URL = "baseurl"
     STAGING = "staging"
+    COMPARE_WORKERS = "compare_workers"
+    COMPARISON = "comparison"
+    PERCEPTUAL_THRESHOLD = "perceptual_threshold"
+    SETTLE_TIMEOUT = "settle_timeout"
+    SETTLE_POLL = "settle_poll"
+    SETTLE_FRAMES = "settle_frames"
+    PARALLEL_STANDS = "parallel_stands"
+    DRIVER_MAX_USES = "driver_max_uses"
+    BASELINE_CACHE = "baseline_cache"
+    BASELINE_TTL = "baseline_ttl"
+    BASELINE_MAX_MB = "baseline_max_mb"
+    BASELINE_INVALIDATE = "baseline_invalidate"
+    STAGING_BUILD = "staging_build"
+    ATTACH_WORKERS = "attach_workers"
+    ATTACH_COMPRESS_LEVEL = "attach_compress_level"
+    ATTACH_FAST_FORMAT_PIXELS = "attach_fast_format_pixels"
+    SKIP_CLEAN_ATTACHMENTS = "skip_clean_attachments"
+    FULL_DIFF = "full_diff"
+    TIMINGS = "timings"
+    TIMINGS_JSON = "timings_json"
+    PROFILE_COMPARE = "profile_compare"
+    BENCHMARK_UPDATE = "benchmark_update"
+    RECORD_FRAMES = "record_frames"
 
 
-@pytest.fixture()
-def driver():
+@functools.lru_cache()
+def chromedriver_path() -> str:
+    """Скачивать драйвер один раз на процесс."""
+    return ChromeDriverManager().install()
+
+
+def create_driver() -> Chrome:
     options = ChromeOptions()
     options.add_argument("--headless")
-    webdriver = Chrome(ChromeDriverManager().install(), desired_capabilities=options.to_capabilities())
+    webdriver = Chrome(chromedriver_path(), desired_capabilities=options.to_capabilities())
     webdriver.implicitly_wait(5)
+    return webdriver
+
+
+@pytest.fixture(scope="session")
+def driver_pool(request):
+    """Прогретые браузеры, переиспользуются между тестами. С pytest-xdist у каждого воркера свой пул."""
+    # Тесты ходят на тестовый и эталонный стенды, хранилища чистятся у обоих
+    base_url = urlparse(request.config.getoption(Config.BASE_URL))
+    # noinspection PyProtectedMember
+    pool = DriverPool(
+        create_driver,
+        max_uses=request.config.getoption(Config.DRIVER_MAX_USES),
+        origins=(base_url.geturl(), base_url._replace(netloc=request.config.getoption(Config.STAGING)).geturl()),
+    )
+    yield pool
+    pool.close()
+
+
+@pytest.fixture()
+def driver(driver_pool):
+    webdriver = driver_pool.acquire()
     yield webdriver
     allure.attach(webdriver.current_url, "last url", allure.attachment_type.URI_LIST)
-    webdriver.quit()
+    driver_pool.release(webdriver)
+
+
+@pytest.fixture()
+def staging_driver(driver_pool):
+    """Второй браузер, в котором параллельно снимаются скриншоты эталонного стенда (--parallel_stands)."""
+    webdriver = driver_pool.acquire()
+    yield webdriver
+    driver_pool.release(webdriver)
+
+
+@pytest.fixture(scope="session")
+def baseline_store(request):
+    """Кэш эталонных скриншотов стейджинга (--baseline_cache), None если кэш выключен."""
+    root = request.config.getoption(Config.BASELINE_CACHE)
+    if not root:
+        return None
+    return BaselineStore(
+        root,
+        ttl=request.config.getoption(Config.BASELINE_TTL),
+        build_id=request.config.getoption(Config.STAGING_BUILD),
+        max_bytes=request.config.getoption(Config.BASELINE_MAX_MB) * 1024 * 1024,
+        invalidate_before=request.config.session_started if request.config.getoption(Config.BASELINE_INVALIDATE) else None,
+    )
 
 
 def pytest_addoption(parser):
@@ -35,6 +118,148 @@ def pytest_addoption(parser):
                      action='store',
                      metavar='str',
                      help='Environment for compare with testing.')
+    parser.addoption(f'--{Config.COMPARE_WORKERS}',
+                     default=1,
+                     dest=Config.COMPARE_WORKERS,
+                     action='store',
+                     type=int,
+                     metavar='int',
+                     help='Number of threads for comparing screenshot bands.')
+    parser.addoption(f'--{Config.COMPARISON}',
+                     default='tolerance',
+                     dest=Config.COMPARISON,
+                     action='store',
+                     choices=('tolerance', 'perceptual'),
+                     help='Default pixel comparison: per channel tolerance or perceptual YIQ with anti-aliasing detection.')
+    parser.addoption(f'--{Config.PERCEPTUAL_THRESHOLD}',
+                     default=0.1,
+                     dest=Config.PERCEPTUAL_THRESHOLD,
+                     action='store',
+                     type=float,
+                     metavar='float',
+                     help='Perceptual comparison threshold from 0 to 1.')
+    parser.addoption(f'--{Config.SETTLE_TIMEOUT}',
+                     default=2.0,
+                     dest=Config.SETTLE_TIMEOUT,
+                     action='store',
+                     type=float,
+                     metavar='float',
+                     help='Max seconds to wait for the page to settle before taking a screenshot.')
+    parser.addoption(f'--{Config.SETTLE_POLL}',
+                     default=0.05,
+                     dest=Config.SETTLE_POLL,
+                     action='store',
+                     type=float,
+                     metavar='float',
+                     help='Page state polling interval in seconds.')
+    parser.addoption(f'--{Config.SETTLE_FRAMES}',
+                     default=False,
+                     dest=Config.SETTLE_FRAMES,
+                     action='store_true',
+                     help='Also compare low-res viewport screenshots when waiting for the page to settle.')
+    parser.addoption(f'--{Config.PARALLEL_STANDS}',
+                     default=False,
+                     dest=Config.PARALLEL_STANDS,
+                     action='store_true',
+                     help='Capture test and staging stands at the same time in two browsers.')
+    parser.addoption(f'--{Config.DRIVER_MAX_USES}',
+                     default=20,
+                     dest=Config.DRIVER_MAX_USES,
+                     action='store',
+                     type=int,
+                     metavar='int',
+                     help='Restart a pooled browser after this number of tests.')
+    parser.addoption(f'--{Config.BASELINE_CACHE}',
+                     default=None,
+                     dest=Config.BASELINE_CACHE,
+                     action='store',
+                     metavar='path',
+                     help='Directory for cached staging screenshots. Staging is captured only on cache miss.')
+    parser.addoption(f'--{Config.BASELINE_TTL}',
+                     default=None,
+                     dest=Config.BASELINE_TTL,
+                     action='store',
+                     type=float,
+                     metavar='float',
+                     help='Cached staging screenshot lifetime in seconds.')
+    parser.addoption(f'--{Config.STAGING_BUILD}',
+                     default=None,
+                     dest=Config.STAGING_BUILD,
+                     action='store',
+                     metavar='str',
+                     help='Staging build id, cached screenshots of other builds are ignored.')
+    parser.addoption(f'--{Config.BASELINE_MAX_MB}',
+                     default=1024,
+                     dest=Config.BASELINE_MAX_MB,
+                     action='store',
+                     type=int,
+                     metavar='int',
+                     help='Max size of the staging screenshots cache in megabytes.')
+    parser.addoption(f'--{Config.BASELINE_INVALIDATE}',
+                     default=False,
+                     dest=Config.BASELINE_INVALIDATE,
+                     action='store_true',
+                     help='Ignore cached staging screenshots taken before this run.')
+    parser.addoption(f'--{Config.ATTACH_WORKERS}',
+                     default=2,
+                     dest=Config.ATTACH_WORKERS,
+                     action='store',
+                     type=int,
+                     metavar='int',
+                     help='Number of threads encoding report attachments.')
+    parser.addoption(f'--{Config.ATTACH_COMPRESS_LEVEL}',
+                     default=1,
+                     dest=Config.ATTACH_COMPRESS_LEVEL,
+                     action='store',
+                     type=int,
+                     metavar='int',
+                     help='PNG compression level (0-9) of report attachments.')
+    parser.addoption(f'--{Config.ATTACH_FAST_FORMAT_PIXELS}',
+                     default=0,
+                     dest=Config.ATTACH_FAST_FORMAT_PIXELS,
+                     action='store',
+                     type=int,
+                     metavar='int',
+                     help='Attach images with more pixels as uncompressed BMP. 0 means always PNG.')
+    parser.addoption(f'--{Config.SKIP_CLEAN_ATTACHMENTS}',
+                     default=False,
+                     dest=Config.SKIP_CLEAN_ATTACHMENTS,
+                     action='store_true',
+                     help="Don't attach actual and expected screenshots when they are equal.")
+    parser.addoption(f'--{Config.FULL_DIFF}',
+                     default=False,
+                     dest=Config.FULL_DIFF,
+                     action='store_true',
+                     help='Attach the whole page diff in full size instead of a downscaled one.')
+    parser.addoption(f'--{Config.TIMINGS}',
+                     default=False,
+                     dest=Config.TIMINGS,
+                     action='store_true',
+                     help='Time pipeline stages and attach a per-test summary to the report.')
+    parser.addoption(f'--{Config.TIMINGS_JSON}',
+                     default=None,
+                     dest=Config.TIMINGS_JSON,
+                     action='store',
+                     metavar='path',
+                     help='Save per-test and per-session timings to a JSON file. Implies --timings.')
+    parser.addoption(f'--{Config.PROFILE_COMPARE}',
+                     default=None,
+                     dest=Config.PROFILE_COMPARE,
+                     action='store',
+                     metavar='path',
+                     help='Profile image comparison with cProfile and save stats to a file.')
+    parser.addoption(f'--{Config.BENCHMARK_UPDATE}',
+                     default=False,
+                     dest=Config.BENCHMARK_UPDATE,
+                     action='store_true',
+                     help='Recalculate benchmark regression thresholds from this run.')
+    parser.addoption(f'--{Config.RECORD_FRAMES}',
+                     default=None,
+                     dest=Config.RECORD_FRAMES,
+                     action='store',
+                     metavar='path',
+                     help='Save captured frames of every check to this directory, '
+                          'to replay comparisons without a browser (python -m screenshot_tests.utils.replay).')
     parser.addoption('--log_level',
                      default='INFO',
                      dest='log_level',
@@ -43,8 +268,50 @@ def pytest_addoption(parser):
                      help='Logging level.')
 
 
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    """Прикрепить к отчету картинки, которые кодировались в фоне, и замеры, пока отчет по тесту еще не сформирован."""
+    timings.begin_test()
+    yield
+    writer = getattr(item.instance, "attachment_writer", None)
+    if writer is not None:
+        writer.flush()
+
+    if timings.enabled:
+        summary = timings.end_test(item.nodeid)
+        logging.info(f"Timings of {item.nodeid}:\n{timings.format(summary)}")
+        allure.attach(json.dumps(summary, indent=2), "timings", allure.attachment_type.JSON)
+
+
 def pytest_configure(config):
     """Configure test run."""
+    # Для --baseline_invalidate. С pytest-xdist у каждого воркера свое время запуска, в худшем случае эталон, который
+    # успел сохранить другой воркер, будет снят заново
+    config.session_started = time.time()
     logging.basicConfig(level=config.getoption('log_level'),
                         format='%(asctime)s [%(levelname)8s] %(message)s (%(filename)s:%(lineno)s)',
                         datefmt='%Y-%m-%d %H:%M:%S')
+    timings.enabled = config.getoption(Config.TIMINGS) or config.getoption(Config.TIMINGS_JSON) is not None
+    if config.getoption(Config.PROFILE_COMPARE):
+        timings.profiler = cProfile.Profile()
+
+
+def _worker_path(path: str) -> str:
+    """С pytest-xdist каждый воркер пишет свой файл"""
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{worker}{extension}"
+
+
+def pytest_unconfigure(config):
+    """Сохранить замеры и профиль сравнения."""
+    if timings.enabled:
+        logging.info(f"Session timings:\n{timings.format(timings.report()['session'])}")
+        if config.getoption(Config.TIMINGS_JSON):
+            timings.save(_worker_path(config.getoption(Config.TIMINGS_JSON)))
+    if timings.profiler is not None:
+        path = _worker_path(config.getoption(Config.PROFILE_COMPARE))
+        timings.profiler.dump_stats(path)
+        logging.info(f"Compare profile is saved to {path}:\n{timings.profile_report()}")
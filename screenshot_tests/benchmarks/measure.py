@@ -0,0 +1,104 @@
+"""Замеры для бенчмарков: лучшее время из нескольких запусков и прирост пиковой памяти процесса."""
+
+import gc
+import multiprocessing
+import os
+import time
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+from screenshot_tests.benchmarks.synthetic import make_page
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+
+CLEAR_REFS = "/proc/self/clear_refs"
+
+
+class Measurement(NamedTuple):
+    # лучшее время из нескольких запусков, в секундах
+    time: float
+    # прирост пикового RSS во время одного запуска, в байтах; 0, если не удалось замерить
+    peak_memory: int
+
+
+def read_status(field: str) -> int:
+    """Значение из /proc/self/status в байтах."""
+    with open("/proc/self/status") as fp:
+        for line in fp:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def can_measure_memory() -> bool:
+    return os.path.exists(CLEAR_REFS)
+
+
+def peak_memory(workload: Callable[[], object]) -> int:
+    """Прирост пикового RSS во время workload в текущем процессе.
+
+    Замер честный только в свежем процессе: освобожденную ранее память аллокатор может не вернуть системе и отдать
+    workload повторно. Поэтому measure() замеряет память в отдельном процессе.
+    """
+    gc.collect()
+    baseline = read_status("VmRSS")
+    # сбрасываем VmHWM до текущего RSS
+    with open(CLEAR_REFS, "w") as fp:
+        fp.write("5")
+    workload()
+    return max(read_status("VmHWM") - baseline, 0)
+
+
+def best_time(workload: Callable[[], object], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        workload()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _prepare_and_measure_memory(prepare: Callable[[], Callable[[], object]]) -> int:
+    """Выполняется в отдельном процессе: подготовить данные и замерить прирост памяти одного запуска."""
+    return peak_memory(prepare())
+
+
+def measure_memory(prepare: Callable[[], Callable[[], object]]) -> int:
+    """Прирост пикового RSS одного запуска нагрузки, которую возвращает prepare(), в новом процессе (spawn).
+
+    prepare должна быть функцией уровня модуля или functools.partial от нее, чтобы ее можно было передать в другой
+    процесс. 0, если память замерить нельзя.
+    """
+    if not can_measure_memory():
+        return 0
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_prepare_and_measure_memory, (prepare,))
+
+
+def measure(prepare: Callable[[], Callable[[], object]], repeat: int = 3) -> Measurement:
+    """Замерить нагрузку, которую возвращает prepare().
+
+    Время -- лучшее из repeat запусков в текущем процессе, память -- см. measure_memory().
+    """
+    return Measurement(best_time(prepare(), repeat), measure_memory(prepare))
+
+
+def calibrate(repeat: int = 5) -> float:
+    """Время эталонной нагрузки (numpy и zlib, как в горячих местах ImageProcessor) на этой машине.
+
+    Пороги регрессий хранятся в долях этого времени, чтобы не зависеть от скорости машины.
+    """
+    return best_time(_calibration_workload(), repeat)
+
+
+def _calibration_workload() -> Callable[[], object]:
+    page = make_page(1425, 1000, seed=42)
+    pixels = np.asarray(page)
+
+    def workload():
+        diff = np.abs(pixels.astype(np.int16) - pixels[::-1])
+        (diff >= 32).any(axis=2).sum()
+        ImageProcessor.image_to_bytes(page)
+
+    return workload
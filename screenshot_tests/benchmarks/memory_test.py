@@ -0,0 +1,49 @@
+"""Пиковая память сравнения: кропы всех блоков (как было) против get_images_diff на срезах общего буфера.
+
+Запуск: pytest screenshot_tests/benchmarks/memory_test.py -s
+"""
+
+from typing import Callable
+
+import pytest
+
+from screenshot_tests.benchmarks.measure import can_measure_memory, measure_memory
+from screenshot_tests.benchmarks.synthetic import make_page, change_region
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+
+WIDTH, HEIGHT = 1425, 20000
+
+
+def _pages():
+    first = make_page(WIDTH, HEIGHT)
+    return first, change_region(first, (100, 10000, 300, 10100))
+
+
+# Функции уровня модуля: память замеряется в отдельном процессе, куда они передаются через pickle
+
+def prepare_materialized_crops() -> Callable[[], object]:
+    """Поведение до изменений: списки кропов всех блоков обоих изображений."""
+    processor, (first, second) = ImageProcessor(), _pages()
+
+    def workload():
+        first_blocks = [{"image": first.crop(box), "box": box} for box in processor._iter_boxes(*first.size)]
+        second_blocks = [{"image": second.crop(box), "box": box} for box in processor._iter_boxes(*second.size)]
+        return len(first_blocks) + len(second_blocks)
+
+    return workload
+
+
+def prepare_vectorized_diff() -> Callable[[], object]:
+    processor, (first, second) = ImageProcessor(), _pages()
+    return lambda: processor.get_images_diff(first, second)[0]
+
+
+@pytest.mark.skipif(not can_measure_memory(), reason="Нужен linux с /proc/self/clear_refs")
+def test_slice_peak_memory():
+    before = measure_memory(prepare_materialized_crops)
+    diff = measure_memory(prepare_vectorized_diff)
+
+    mb = 1024 * 1024
+    print(f"\nPeak memory on {WIDTH}x{HEIGHT}: crops {before / mb:.1f} MB, get_images_diff {diff / mb:.1f} MB")
+    # Одни кропы без сравнения -- нижняя граница старого сравнения, настоящее сравнение должно уложиться меньше
+    assert diff < before
@@ -0,0 +1,49 @@
+"""Сравнение высоких страниц полосами в пуле потоков: время в зависимости от высоты и количества потоков.
+
+Замеряется только поблочное сравнение, без отрисовки и кодирования картинки с диффом. Ускорение проверяется только
+для количества потоков, под которое на машине хватает ядер.
+
+Запуск: pytest screenshot_tests/benchmarks/parallel_test.py -s
+"""
+
+import os
+
+from PIL import ImageDraw
+
+from screenshot_tests.benchmarks.measure import best_time
+from screenshot_tests.benchmarks.synthetic import make_page
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+
+WIDTH = 1425
+HEIGHTS = (2900, 10000, 20000)
+WORKERS = (1, 2, 4, 8)
+
+
+def test_workers_sweep():
+    cpu_count = os.cpu_count() or 1
+    lines = [f"\nCPU count: {cpu_count}", f"{'height':>8} {'workers':>8} {'time, s':>10} {'speedup':>8}"]
+    speedups = {}
+    for height in HEIGHTS:
+        first = make_page(WIDTH, height, seed=height)
+        # меняем каждую вторую полосу, чтобы не сработал пропуск по хэшам
+        second = first.copy()
+        draw = ImageDraw.Draw(second)
+        for top in range(0, height, 80):
+            draw.rectangle((0, top, WIDTH, top + 2), fill="gray")
+
+        single = None
+        expected = ImageProcessor().get_images_diff(first, second)
+        for workers in WORKERS:
+            processor = ImageProcessor(workers=workers)
+            assert processor.get_images_diff(first, second) == expected
+            elapsed = best_time(lambda: processor._compare_blocks_vectorized(first, second), 3)
+            single = single or elapsed
+            speedups[height, workers] = single / elapsed
+            lines.append(f"{height:>8} {workers:>8} {elapsed:>10.3f} {single / elapsed:>8.2f}")
+
+    print("\n".join(lines))
+    # На машине с меньшим количеством ядер, чем потоков, ускорения нет и быть не должно
+    for workers in WORKERS:
+        if 1 < workers <= cpu_count:
+            assert speedups[HEIGHTS[-1], workers] > 1, \
+                f"{workers} потоков не ускоряют сравнение страницы высотой {HEIGHTS[-1]}: {speedups[HEIGHTS[-1], workers]:.2f}"
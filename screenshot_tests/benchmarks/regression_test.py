@@ -0,0 +1,160 @@
+"""Производительность ImageProcessor на синтетических страницах: скорость, пиковая память и пороги регрессий.
+
+Время каждого бенчмарка делится на время эталонной нагрузки (measure.calibrate) на этой же машине и сравнивается с
+порогом из thresholds.json. Бенчмарки без порога только печатаются. После осознанного изменения производительности
+пороги пересчитываются с --benchmark_update.
+
+Запуск: pytest screenshot_tests/benchmarks/regression_test.py -s
+"""
+
+import json
+import os
+from functools import partial
+from typing import Callable, Dict, Tuple
+
+import pytest
+
+from conftest import Config
+from screenshot_tests.benchmarks.measure import Measurement, calibrate, measure
+from screenshot_tests.benchmarks.synthetic import antialias_noise, change_height, change_region, make_page
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(__file__), "thresholds.json")
+# запас при пересчете порогов: шум замеров на общих машинах CI
+TIME_MARGIN = 1.5
+MEMORY_MARGIN = 1.25
+MEMORY_SLACK = 16 * 1024 * 1024
+
+WIDTH = 1425
+VIEWPORT = 900
+
+
+def _page(height: int, seed: int = 0):
+    return make_page(WIDTH, height, seed=seed)
+
+
+def _diff(first, second, **kwargs) -> Callable[[], object]:
+    processor = ImageProcessor(**kwargs)
+    return lambda: processor.get_images_diff(first, second)
+
+
+# Функции, которые готовят данные и возвращают нагрузку. Должны быть уровня модуля: память замеряется в отдельном
+# процессе, куда они передаются через pickle.
+
+def prepare_slice_image(height: int) -> Callable[[], object]:
+    processor, image = ImageProcessor(), _page(height)
+    return lambda: sum(1 for _ in processor._slice_image(image))
+
+
+def prepare_diff_identical(height: int) -> Callable[[], object]:
+    return _diff(_page(height), _page(height))
+
+
+def prepare_diff_near_identical(height: int) -> Callable[[], object]:
+    first = _page(height)
+    return _diff(first, change_region(first, (100, height // 2, 300, height // 2 + 100)))
+
+
+def prepare_diff_antialias(height: int, comparison: str = ImageProcessor.COMPARISON_TOLERANCE) -> Callable[[], object]:
+    first = _page(height)
+    return _diff(first, antialias_noise(first), comparison=comparison)
+
+
+def prepare_diff_size_mismatch(height: int) -> Callable[[], object]:
+    return _diff(_page(height), change_height(_page(height), 300))
+
+
+def prepare_diff_reference(height: int) -> Callable[[], object]:
+    first = _page(height)
+    return _diff(first, change_region(first, (0, 0, 50, 50)), engine=ImageProcessor.ENGINE_REFERENCE)
+
+
+def prepare_paste(frames: int) -> Callable[[], object]:
+    processor = ImageProcessor()
+    screenshots = [ImageProcessor.image_to_bytes(_page(VIEWPORT, seed), compress_level=1) for seed in range(frames)]
+    return lambda: processor.paste(screenshots, VIEWPORT // 2)
+
+
+def prepare_load_image(height: int) -> Callable[[], object]:
+    data = ImageProcessor.image_to_bytes(_page(height))
+    return lambda: ImageProcessor.load_image_from_bytes(data)
+
+
+def prepare_image_to_bytes(height: int, compress_level: int) -> Callable[[], object]:
+    image = _page(height)
+    return lambda: ImageProcessor.image_to_bytes(image, compress_level=compress_level)
+
+
+# название -> (подготовка нагрузки, количество обработанных пикселей для расчета скорости)
+BENCHMARKS: Dict[str, Tuple[Callable[[], Callable[[], object]], int]] = {
+    "slice_image_2900": (partial(prepare_slice_image, 2900), WIDTH * 2900),
+    "diff_identical_2900": (partial(prepare_diff_identical, 2900), WIDTH * 2900),
+    "diff_identical_20000": (partial(prepare_diff_identical, 20000), WIDTH * 20000),
+    "diff_near_identical_10000": (partial(prepare_diff_near_identical, 10000), WIDTH * 10000),
+    "diff_antialias_2900": (partial(prepare_diff_antialias, 2900), WIDTH * 2900),
+    "diff_antialias_perceptual_2900": (
+        partial(prepare_diff_antialias, 2900, ImageProcessor.COMPARISON_PERCEPTUAL), WIDTH * 2900
+    ),
+    "diff_size_mismatch_2900": (partial(prepare_diff_size_mismatch, 2900), WIDTH * 2900),
+    "diff_reference_400": (partial(prepare_diff_reference, 400), WIDTH * 400),
+    "paste_10_viewports": (partial(prepare_paste, 10), WIDTH * VIEWPORT * 10),
+    "load_image_from_bytes_2900": (partial(prepare_load_image, 2900), WIDTH * 2900),
+    "image_to_bytes_2900": (partial(prepare_image_to_bytes, 2900, 6), WIDTH * 2900),
+    "image_to_bytes_fast_2900": (partial(prepare_image_to_bytes, 2900, 1), WIDTH * 2900),
+}
+
+
+def _load_thresholds() -> dict:
+    if not os.path.exists(THRESHOLDS_PATH):
+        return {}
+    with open(THRESHOLDS_PATH) as fp:
+        return json.load(fp)["benchmarks"]
+
+
+@pytest.fixture(scope="module")
+def calibration() -> float:
+    return calibrate()
+
+
+@pytest.fixture(scope="module")
+def results(request):
+    """Результаты всех бенчмарков модуля; с --benchmark_update по ним в конце пересчитываются пороги."""
+    measurements: Dict[str, Measurement] = {}
+    yield measurements
+
+    if request.config.getoption(Config.BENCHMARK_UPDATE) and measurements:
+        calibration_time = request.getfixturevalue("calibration")
+        thresholds = _load_thresholds()
+        for name, measurement in measurements.items():
+            thresholds[name] = {
+                "time": round(measurement.time / calibration_time * TIME_MARGIN, 3),
+                "memory": int(measurement.peak_memory * MEMORY_MARGIN + MEMORY_SLACK),
+            }
+        with open(THRESHOLDS_PATH, "w") as fp:
+            json.dump({
+                "description": "time -- max ratio to measure.calibrate(), memory -- max peak RSS growth in bytes",
+                "benchmarks": dict(sorted(thresholds.items())),
+            }, fp, indent=2)
+            fp.write("\n")
+
+
+@pytest.mark.parametrize("name", list(BENCHMARKS))
+def test_benchmark(name, calibration, results, request):
+    prepare, pixels = BENCHMARKS[name]
+    measurement = measure(prepare)
+    results[name] = measurement
+
+    ratio = measurement.time / calibration
+    mb = 1024 * 1024
+    print(f"\n{name}: {measurement.time:.4f}s ({ratio:.2f} x calibration), "
+          f"{pixels / measurement.time / 1e6:.1f} Mpx/s, peak memory +{measurement.peak_memory / mb:.1f} MB")
+
+    threshold = _load_thresholds().get(name)
+    if threshold is None or request.config.getoption(Config.BENCHMARK_UPDATE):
+        return
+    assert ratio <= threshold["time"], \
+        f"{name} стал медленнее: {ratio:.2f} x calibration, порог {threshold['time']}"
+    if measurement.peak_memory:
+        assert measurement.peak_memory <= threshold["memory"], \
+            f"{name} использует больше памяти: {measurement.peak_memory / mb:.1f} MB, " \
+            f"порог {threshold['memory'] / mb:.1f} MB"
@@ -0,0 +1,64 @@
+"""Синтетические «скриншоты» для бенчмарков, без браузера и сети."""
+
+import random
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def make_page(width: int, height: int, seed: int = 0, mode: str = "RGB") -> Image.Image:
+    """Сгенерировать страницу: белый фон, цветные блоки и строки «текста» из мелких прямоугольников."""
+    rnd = random.Random(seed)
+    image = Image.new(mode, (width, height), "white")
+    draw = ImageDraw.Draw(image)
+
+    top = 0
+    while top < height:
+        if rnd.random() < 0.3:
+            # картинка или баннер
+            block_height = rnd.randint(80, 400)
+            left = rnd.randint(0, width // 2)
+            color = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+            draw.rectangle((left, top, rnd.randint(left, width), top + block_height), fill=color)
+        else:
+            # абзац текста: строки из «слов»
+            block_height = 0
+            for _ in range(rnd.randint(2, 8)):
+                left = 20
+                while left < width - 60:
+                    word = rnd.randint(10, 60)
+                    draw.rectangle((left, top + block_height, left + word, top + block_height + 12), fill="black")
+                    left += word + 8
+                block_height += 20
+        top += block_height + rnd.randint(10, 60)
+
+    return image
+
+
+def change_region(image: Image.Image, box, color="red") -> Image.Image:
+    """Копия изображения с закрашенной областью box."""
+    changed = image.copy()
+    ImageDraw.Draw(changed).rectangle(box, fill=color)
+    return changed
+
+
+def antialias_noise(image: Image.Image, seed: int = 0, share: float = 0.5) -> Image.Image:
+    """Копия изображения, в которой часть пикселей на вертикальных границах (края «букв») заменена промежуточным
+    цветом, как при другом сглаживании шрифтов."""
+    rng = np.random.default_rng(seed)
+    pixels = np.array(image)
+    right = pixels[:, 1:]
+    left = pixels[:, :-1]
+    edges = (left != right).any(axis=2) & (rng.random(left.shape[:2]) < share)
+    weights = rng.random(left.shape[:2])[..., None]
+    blended = (left * weights + right * (1 - weights)).astype(np.uint8)
+    left[edges] = blended[edges]
+    return Image.fromarray(pixels, image.mode)
+
+
+def change_height(image: Image.Image, extra: int, color="white") -> Image.Image:
+    """Копия изображения, выше на extra пикселей (снизу добавлено место), как при сдвинувшемся подвале."""
+    width, height = image.size
+    changed = Image.new(image.mode, (width, height + extra), color)
+    changed.paste(image, (0, 0))
+    return changed
@@ -1,9 +1,33 @@
+import hashlib
+import functools
 import logging
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Union, List
+from typing import Union, List, Tuple, Iterator, Optional, NamedTuple, Callable
 
+import numpy as np
 from PIL import ImageDraw, Image
 
+from screenshot_tests.utils.timing import timings
+
+Box = Tuple[int, int, int, int]
+
+
+class DiffRegion(NamedTuple):
+    """Область отличий: связная группа битых блоков"""
+    # ограничивающий прямоугольник (left, top, right, bottom)
+    box: Box
+    # битые блоки области
+    blocks: List[Box]
+    # площадь прямоугольника в пикселях
+    area: int
+    # максимальная разница по каналам внутри прямоугольника (0-255)
+    max_delta: int
+
 
 class ImageProcessor(object):
     """Класс для обработки изображений (нарезки и сравнения)"""
@@ -22,41 +46,104 @@ class ImageProcessor(object):
         ALPHA: 32,
     }
 
-    def __init__(self):
-        self._block_width = 40  # default
-        self._block_height = 40
-
-    def _slice_image(self, image: Image.Image) -> List[dict]:
-        """Нарезать картинки на блоки"""
-        max_width, max_height = image.size
-
-        # нижний правый угол для кропа
-        width_change = self._block_width
-        height_change = self._block_height
-
-        result = []
-        for row in range(0, max_height, self._block_height):
-            for col in range(0, max_width, self._block_width):
-                # Если дошли до края изображения
-                if width_change > max_width:
-                    width_change = max_width
-                # отрезаем по краю
-                if height_change > max_height:
-                    height_change = max_height
-
+    # Сравнение всего кадра массивами numpy
+    ENGINE_VECTORIZED = "vectorized"
+    # Старое попиксельное сравнение через getpixel(), оставлено как эталон для тестов эквивалентности
+    ENGINE_REFERENCE = "reference"
+
+    # Пиксели совпадают, если разница по каждому каналу меньше self.tolerance
+    COMPARISON_TOLERANCE = "tolerance"
+    # Перцептивная разница в пространстве YIQ с поиском антиалиазинга, как в pixelmatch
+    # https://github.com/mapbox/pixelmatch/blob/v5.3.0/index.js
+    COMPARISON_PERCEPTUAL = "perceptual"
+
+    # Максимальная разница YIQ (между черным и белым)
+    YIQ_MAX_DELTA = 35215
+    # Разница YIQ не больше YIQ_CHANNEL_BOUND * d², где d -- максимальная разница по каналам RGB. Это сумма квадратов
+    # сумм модулей коэффициентов Y, I и Q, взвешенная как в _yiq_delta.
+    YIQ_CHANNEL_BOUND = 1.1439
+
+    def __init__(
+        self,
+        engine: str = ENGINE_VECTORIZED,
+        workers: int = 1,
+        comparison: str = COMPARISON_TOLERANCE,
+        threshold: float = 0.1,
+        detect_antialiasing: bool = True,
+        block_size: int = 40
+    ):
+        """
+        :param engine: движок сравнения, ENGINE_VECTORIZED или ENGINE_REFERENCE.
+        :param workers: количество потоков, в которых сравниваются полосы изображения.
+        :param comparison: сравнение пикселей по умолчанию, COMPARISON_TOLERANCE или COMPARISON_PERCEPTUAL.
+        :param threshold: порог перцептивной разницы (0-1), доля от YIQ_MAX_DELTA в квадрате, как в pixelmatch.
+        :param detect_antialiasing: не считать отличием антиалиазинг при перцептивном сравнении.
+        :param block_size: сторона блока в пикселях.
+        """
+        assert engine in (self.ENGINE_VECTORIZED, self.ENGINE_REFERENCE), f"Неизвестный движок сравнения: {engine}"
+        assert workers >= 1, f"Количество потоков должно быть положительным: {workers}"
+        self._check_comparison(engine, comparison)
+        assert 0 <= threshold <= 1, f"Порог должен быть от 0 до 1: {threshold}"
+        self._engine = engine
+        self._workers = workers
+        self._comparison = comparison
+        self._threshold = threshold
+        self._detect_antialiasing = detect_antialiasing
+        assert block_size >= 1, f"Размер блока должен быть положительным: {block_size}"
+        self._block_width = block_size
+        self._block_height = block_size
+        # счетчики для отчета о попаданиях в хэши и сэкономленном времени, см. get_stats_report()
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def settings(self, comparison: Optional[str] = None) -> dict:
+        """Настройки сравнения, с которыми можно создать такой же ImageProcessor (tolerance задается отдельно)."""
+        return {
+            "comparison": comparison or self._comparison,
+            "threshold": self._threshold,
+            "detect_antialiasing": self._detect_antialiasing,
+            "block_size": self._block_width,
+            "tolerance": dict(self.tolerance),
+        }
+
+    def _check_comparison(self, engine: str, comparison: str):
+        assert comparison in (self.COMPARISON_TOLERANCE, self.COMPARISON_PERCEPTUAL), \
+            f"Неизвестное сравнение пикселей: {comparison}"
+        assert engine == self.ENGINE_VECTORIZED or comparison == self.COMPARISON_TOLERANCE, \
+            f"Движок {engine} поддерживает только сравнение {self.COMPARISON_TOLERANCE}"
+
+    def _iter_boxes(self, width: int, height: int) -> Iterator[Box]:
+        """Лениво перебрать координаты блоков (слева направо, сверху вниз), края изображения обрезаются"""
+        for row in range(0, height, self._block_height):
+            for col in range(0, width, self._block_width):
                 # col, row -- верхний левый угол
-                box = (col, row, width_change, height_change)
-                cropped = image.crop(box)
-                result.append({"image": cropped, "box": box})
-                # сдвигаем вправо по ширине
-                width_change += self._block_width
+                yield col, row, min(col + self._block_width, width), min(row + self._block_height, height)
 
-            # сдвигаем вниз по высоте
-            height_change += self._block_height
-            # возвращаем указатель на ширину в стартовую позицию
-            width_change = self._block_width
+    def _slice_image(self, image: Image.Image) -> Iterator[dict]:
+        """Нарезать картинки на блоки.
 
-        return result
+        Блоки кропаются по одному при переборе, чтобы в памяти не висели все кропы сразу.
+        """
+        for box in self._iter_boxes(*image.size):
+            yield {"image": image.crop(box), "box": box}
+
+    def _iter_bands(
+        self,
+        first: np.ndarray,
+        second: np.ndarray,
+        rows: Optional[range] = None
+    ) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """Перебрать ряды блоков (по умолчанию все) двух массивов одного размера.
+
+        Отдаются срезы (view) исходных массивов, пиксели при этом не копируются.
+        """
+        if rows is None:
+            rows = range(-(-first.shape[0] // self._block_height))
+
+        for row in rows:
+            top = row * self._block_height
+            bottom = top + self._block_height
+            yield top, first[top:bottom], second[top:bottom]
 
     def _is_color_similar(self, a, b, color):
         """Проверить похожесть цветов. Для того, чтобы тесты не тригеррились на антиалиазинг допуски
@@ -103,27 +190,574 @@ class ImageProcessor(object):
 
         return True
 
-    def get_images_diff(self, first_image: Image.Image, second_image: Image.Image) -> List[Union[int, bytes]]:
-        """Поблочно сравнить два изображения и вернуть количество блоков с несовпавшими пикселями"""
-        result_image = first_image.copy()
-
-        first_image_blocks = self._slice_image(first_image)
-        second_image_blocks = self._slice_image(second_image)
-
+    def _compare_blocks_reference(self, first_image: Image.Image, second_image: Image.Image) -> Tuple[int, List[Box]]:
+        """Попиксельно сравнить блоки, вернуть количество несовпавших блоков и их координаты"""
         # если скриншоты разных размеров, то все блоки из большего скриншота, которые не попали в меньший нужно добавить
         # к битым
-        mistaken_blocks = abs(len(first_image_blocks) - len(second_image_blocks))
+        mistaken_blocks = abs(self._count_blocks(*first_image.size) - self._count_blocks(*second_image.size))
+        boxes = []
 
-        for index in range(min(len(first_image_blocks), len(second_image_blocks))):
-            image_equal = self._compare_images(first_image_blocks[index]["image"], second_image_blocks[index]["image"])
+        for first_block, second_block in zip(self._slice_image(first_image), self._slice_image(second_image)):
+            image_equal = self._compare_images(first_block["image"], second_block["image"])
 
             if not image_equal:
-                draw = ImageDraw.Draw(result_image)
-                draw.rectangle(first_image_blocks[index]["box"], outline="red")
+                boxes.append(first_block["box"])
                 mistaken_blocks += 1
 
+        return mistaken_blocks, boxes
+
+    @classmethod
+    def _to_arrays(cls, first_image: Image.Image, second_image: Image.Image) -> Tuple[np.ndarray, np.ndarray]:
+        """Декодировать оба изображения в непрерывные массивы (height, width, channels) с одинаковым набором каналов"""
+        mode = first_image.mode
+        if mode != second_image.mode or mode not in ("RGB", "RGBA"):
+            mode = "RGBA"
+
+        return cls._to_array(first_image, mode), cls._to_array(second_image, mode)
+
+    @staticmethod
+    def _to_array(image: Image.Image, mode: str) -> np.ndarray:
+        """Скопировать пиксели в массив полосами, чтобы не держать в памяти промежуточную копию всего изображения"""
+        if image.mode != mode:
+            image = image.convert(mode)
+
+        width, height = image.size
+        pixels = np.empty((height, width, len(mode)), dtype=np.uint8)
+        for top in range(0, height, 1024):
+            bottom = min(top + 1024, height)
+            pixels[top:bottom] = np.asarray(image.crop((0, top, width, bottom)))
+
+        return pixels
+
+    @staticmethod
+    def _band_digest(band: np.ndarray) -> bytes:
+        return hashlib.blake2b(np.ascontiguousarray(band), digest_size=16).digest()
+
+    def band_digests(self, image: Image.Image) -> List[bytes]:
+        """Хэши рядов блоков изображения.
+
+        Их можно сохранить вместе с изображением (например, эталоном) и передать в get_images_diff, чтобы не считать
+        заново.
+        """
+        mode = image.mode if image.mode in ("RGB", "RGBA") else "RGBA"
+        pixels = self._to_array(image, mode)
+        return [
+            self._band_digest(pixels[top:top + self._block_height])
+            for top in range(0, pixels.shape[0], self._block_height)
+        ]
+
+    def _tolerance_vector(self, channels: int) -> np.ndarray:
+        """Допуски self.tolerance в порядке каналов массива.
+
+        Разница 0 всегда считается совпадением, поэтому нулевой допуск эквивалентен допуску 1.
+        """
+        colors = (self.RED, self.GREEN, self.BLUE, self.ALPHA)[:channels]
+        return np.array([max(self.tolerance[color], 1) for color in colors], dtype=np.int16)
+
+    def _compare_blocks_vectorized(
+        self,
+        first_image: Image.Image,
+        second_image: Image.Image,
+        second_digests: Optional[List[bytes]] = None,
+        comparison: Optional[str] = None,
+        split_rows: bool = True
+    ) -> Tuple[int, List[Box]]:
+        """Сравнить изображения массивами по рядам блоков (при workers > 1 -- полосами в пуле потоков).
+
+        Блоки сравниваются только если они совпадают по координатам в обоих изображениях, остальные блоки (которые
+        есть только в одном из изображений) считаются битыми. Для картинок одного размера и одинаковой ширины результат
+        совпадает с ENGINE_REFERENCE.
+        :param second_digests: посчитанные заранее band_digests(second_image).
+        :param comparison: сравнение пикселей вместо заданного в конструкторе.
+        :param split_rows: сравнивать полосами в пуле потоков. Выключается, когда в пуле сравниваются сами пары
+            изображений, см. get_batch_diff_regions.
+        """
+        comparison = comparison or self._comparison
+        first, second = self._to_arrays(first_image, second_image)
+        (first_height, first_width), (second_height, second_width) = first.shape[:2], second.shape[:2]
+        if second_digests is not None and len(second_digests) != -(-second_height // self._block_height):
+            second_digests = None
+        height, width = min(first_height, second_height), min(first_width, second_width)
+
+        # последний неполный ряд (колонка) общей области совпадает по координатам, только если размеры изображений равны
+        common_rows = -(-height // self._block_height)
+        common_cols = -(-width // self._block_width)
+        if height % self._block_height and first_height != second_height:
+            common_rows -= 1
+        if width % self._block_width and first_width != second_width:
+            common_cols -= 1
+
+        first_blocks = self._count_blocks(first_width, first_height)
+        second_blocks = self._count_blocks(second_width, second_height)
+        mistaken_blocks = first_blocks + second_blocks - 2 * common_rows * common_cols
+
+        first, second = first[:height, :width], second[:height, :width]
+        if comparison == self.COMPARISON_PERCEPTUAL:
+            compare_band = functools.partial(self._compare_band_perceptual, first, second)
+        else:
+            compare_band = functools.partial(self._compare_band, tolerance=self._tolerance_vector(first.shape[2]))
+
+        compare_rows = functools.partial(
+            self._compare_rows,
+            first,
+            second,
+            compare_band=compare_band,
+            common_cols=common_cols,
+            # ряды блоков выровнены одинаково только при одинаковой ширине, тогда совпавшие по хэшу ряды можно не сравнивать
+            use_digests=first_width == second_width,
+            second_digests=second_digests,
+        )
+        strips = self._split_rows(common_rows) if split_rows else [range(common_rows)]
+        if len(strips) > 1:
+            # numpy и hashlib отпускают GIL, поэтому потоки работают параллельно над общими буферами без копирования
+            with ThreadPoolExecutor(self._workers) as executor:
+                results = list(executor.map(compare_rows, strips))
+        else:
+            results = [compare_rows(strip) for strip in strips]
+
+        boxes = []
+        stats = Counter(comparisons=1, bands=common_rows)
+        for strip_mistaken, strip_boxes, strip_stats in results:
+            mistaken_blocks += strip_mistaken
+            boxes.extend(strip_boxes)
+            stats.update(strip_stats)
+
+        if first.shape == second.shape and stats["identical_bands"] == common_rows:
+            stats["identical_images"] += 1
+        self._update_stats(stats)
+
+        return mistaken_blocks, boxes
+
+    def _update_stats(self, stats: Counter):
+        # сравнения идут из нескольких потоков, а Counter.update не атомарен
+        with self._stats_lock:
+            self.stats.update(stats)
+
+    def _split_rows(self, rows: int) -> List[range]:
+        """Разбить ряды блоков на горизонтальные полосы для пула потоков.
+
+        Полос больше, чем потоков, чтобы потоки, которым достались совпавшие по хэшу ряды, не простаивали.
+        """
+        if self._workers <= 1 or rows <= 1:
+            return [range(rows)]
+
+        strip = -(-rows // (self._workers * 4))
+        return [range(start, min(start + strip, rows)) for start in range(0, rows, strip)]
+
+    def _compare_rows(
+        self,
+        first: np.ndarray,
+        second: np.ndarray,
+        rows: range,
+        compare_band: Callable[[int, np.ndarray, np.ndarray], np.ndarray],
+        common_cols: int,
+        use_digests: bool,
+        second_digests: Optional[List[bytes]] = None
+    ) -> Tuple[int, List[Box], Counter]:
+        """Сравнить полосу из рядов блоков общей области, вернуть количество битых блоков, их координаты и счетчики.
+
+        :param compare_band: функция (top, first_band, second_band), которая возвращает флаги «блок битый» ряда.
+        """
+        height, width = first.shape[:2]
+        mistaken_blocks = 0
+        boxes = []
+        stats = Counter()
+
+        # сравниваем по одному ряду блоков, чтобы временные массивы были размером с ряд, а не с кадр
+        for top, first_band, second_band in self._iter_bands(first, second, rows):
+            if use_digests:
+                started = time.perf_counter()
+                if second_digests is not None:
+                    second_digest = second_digests[top // self._block_height]
+                else:
+                    second_digest = self._band_digest(second_band)
+                equal = self._band_digest(first_band) == second_digest
+                stats["hash_time"] += time.perf_counter() - started
+                if equal:
+                    stats["identical_bands"] += 1
+                    continue
+
+            started = time.perf_counter()
+            failed = compare_band(top, first_band, second_band)[:common_cols]
+            stats["compare_time"] += time.perf_counter() - started
+            mistaken_blocks += int(failed.sum())
+
+            bottom = min(top + self._block_height, height)
+            for col in np.nonzero(failed)[0]:
+                left = int(col) * self._block_width
+                boxes.append((left, top, min(left + self._block_width, width), bottom))
+
+        return mistaken_blocks, boxes, stats
+
+    def _compare_band(
+        self,
+        top: int,
+        first_band: np.ndarray,
+        second_band: np.ndarray,
+        tolerance: np.ndarray
+    ) -> np.ndarray:
+        """Сравнить ряд блоков с допусками по каналам, вернуть массив флагов «блок битый» по колонкам"""
+        diff = np.abs(first_band.astype(np.int16) - second_band)
+        return self._pool_blocks((diff >= tolerance).any(axis=2), np.any)
+
+    def _pool_blocks(self, values: np.ndarray, reduce: Callable) -> np.ndarray:
+        """Свернуть массив (height, width) ряда блоков в массив по колонкам блоков функцией reduce (np.any, np.max)"""
+        height, width = values.shape
+        cols = -(-width // self._block_width)
+        # дополняем массив нулями до целого количества блоков, чтобы свернуть его через reshape
+        padded = np.zeros((height, cols * self._block_width), dtype=values.dtype)
+        padded[:, :width] = values
+        return reduce(padded.reshape(height, cols, self._block_width), axis=(0, 2))
+
+    @staticmethod
+    def _blend(pixels: np.ndarray) -> np.ndarray:
+        """RGB(A) -> RGB float32, прозрачность смешивается с белым фоном"""
+        rgb = pixels[..., :3].astype(np.float32)
+        if pixels.shape[-1] == 4:
+            alpha = pixels[..., 3:].astype(np.float32) / 255
+            rgb = 255 + (rgb - 255) * alpha
+        return rgb
+
+    @staticmethod
+    def _brightness(rgb: np.ndarray) -> np.ndarray:
+        return rgb[..., 0] * 0.29889531 + rgb[..., 1] * 0.58662247 + rgb[..., 2] * 0.11448223
+
+    @classmethod
+    def _yiq_delta(cls, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        """Квадрат перцептивной разницы пикселей в YIQ (0..YIQ_MAX_DELTA)"""
+        first, second = cls._blend(first), cls._blend(second)
+        delta = first - second
+        y = cls._brightness(delta)
+        i = delta[..., 0] * 0.59597799 - delta[..., 1] * 0.27417610 - delta[..., 2] * 0.32180189
+        q = delta[..., 0] * 0.21147017 - delta[..., 1] * 0.52261711 + delta[..., 2] * 0.31114694
+        return 0.5053 * y * y + 0.299 * i * i + 0.1957 * q * q
+
+    # соседи пикселя в порядке обхода pixelmatch (по колонкам), от него зависит выбор самого темного и светлого соседа
+    _NEIGHBOURS = [(dy, dx) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dy or dx]
+
+    @classmethod
+    def _neighbours(cls, pixels: np.ndarray, ys: np.ndarray, xs: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Соседи точек: пиксели (points, 8, channels), флаги «сосед в пределах изображения» и «точка на краю»"""
+        height, width = pixels.shape[:2]
+        offsets = np.array(cls._NEIGHBOURS)
+        neighbour_ys = ys[:, None] + offsets[:, 0]
+        neighbour_xs = xs[:, None] + offsets[:, 1]
+        valid = (neighbour_ys >= 0) & (neighbour_ys < height) & (neighbour_xs >= 0) & (neighbour_xs < width)
+        on_edge = ~valid.all(axis=1)
+        values = pixels[np.clip(neighbour_ys, 0, height - 1), np.clip(neighbour_xs, 0, width - 1)]
+        return values, valid, on_edge
+
+    @classmethod
+    def _has_many_siblings(cls, pixels: np.ndarray, ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+        """Есть ли у точек больше двух соседей точно такого же цвета (край изображения считается за одного)"""
+        values, valid, on_edge = cls._neighbours(pixels, ys, xs)
+        same = (values == pixels[ys, xs][:, None]).all(axis=2) & valid
+        return same.sum(axis=1) + on_edge > 2
+
+    @classmethod
+    def _antialiased(cls, pixels: np.ndarray, other: np.ndarray, ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+        """Похожи ли точки pixels на антиалиазинг: у точки есть и более темный, и более светлый сосед, и хотя бы один
+        из них (самый темный или самый светлый) лежит на однотонной области в обоих изображениях.
+        """
+        values, valid, on_edge = cls._neighbours(pixels, ys, xs)
+        delta = cls._brightness(cls._blend(pixels[ys, xs]))[:, None] - cls._brightness(cls._blend(values))
+        delta[~valid] = np.nan
+        zeroes = (delta == 0).sum(axis=1) + on_edge
+        delta = np.nan_to_num(delta)
+
+        points = np.arange(len(ys))
+        darkest, brightest = delta.argmin(axis=1), delta.argmax(axis=1)
+        result = (zeroes <= 2) & (delta[points, darkest] < 0) & (delta[points, brightest] > 0)
+
+        # соседей соседей проверяем только для оставшихся точек, это самая дорогая часть
+        candidates = np.nonzero(result)[0]
+        offsets = np.array(cls._NEIGHBOURS)
+        flat = np.zeros(len(candidates), dtype=bool)
+        for neighbour in (darkest[candidates], brightest[candidates]):
+            neighbour_ys = ys[candidates] + offsets[neighbour, 0]
+            neighbour_xs = xs[candidates] + offsets[neighbour, 1]
+            flat |= cls._has_many_siblings(pixels, neighbour_ys, neighbour_xs) & \
+                cls._has_many_siblings(other, neighbour_ys, neighbour_xs)
+
+        result[candidates] = flat
+        return result
+
+    def _find_real_mismatch(
+        self,
+        first: np.ndarray,
+        second: np.ndarray,
+        ys: np.ndarray,
+        xs: np.ndarray,
+        blocks: np.ndarray,
+        count: int
+    ) -> np.ndarray:
+        """Есть ли в блоках отличающиеся пиксели (ys, xs), которые не похожи на антиалиазинг.
+
+        Блоку достаточно одного такого пикселя, поэтому пиксели проверяются порциями растущего размера и для блоков,
+        в которых он уже найден, дальше не проверяются: при настоящих изменениях хватает первой порции.
+        :param blocks: номера блоков пикселей (0..count-1).
+        """
+        order = np.argsort(blocks, kind="stable")
+        ys, xs, blocks = ys[order], xs[order], blocks[order]
+        # номер пикселя внутри его блока
+        rank = np.arange(len(blocks)) - np.searchsorted(blocks, blocks)
+
+        failed = np.zeros(count, dtype=bool)
+        low, high = 0, 64
+        while low <= rank.max():
+            chosen = (rank >= low) & (rank < high) & ~failed[blocks]
+            if chosen.any():
+                chosen_ys, chosen_xs = ys[chosen], xs[chosen]
+                antialiased = self._antialiased(first, second, chosen_ys, chosen_xs)
+                rest = ~antialiased
+                antialiased[rest] = self._antialiased(second, first, chosen_ys[rest], chosen_xs[rest])
+                failed[blocks[chosen][~antialiased]] = True
+            low, high = high, high * 4
+
+        return failed
+
+    def _compare_band_perceptual(
+        self,
+        first: np.ndarray,
+        second: np.ndarray,
+        top: int,
+        first_band: np.ndarray,
+        second_band: np.ndarray
+    ) -> np.ndarray:
+        """Сравнить ряд блоков перцептивно, вернуть массив флагов «блок битый» по колонкам.
+
+        Сначала по максимальной разнице каналов в блоке оценивается сверху разница YIQ: если оценка не больше порога,
+        блок совпадает и YIQ для него не считается. Антиалиазинг ищется только среди пикселей выше порога, с соседями
+        из полных изображений first и second, поэтому границы рядов блоков не мешают.
+        """
+        max_delta = self.YIQ_MAX_DELTA * self._threshold ** 2
+        channel_diff = np.maximum(first_band, second_band) - np.minimum(first_band, second_band)
+        block_diff = self._pool_blocks(channel_diff.max(axis=2), np.max).astype(np.float64)
+        # смешивание с белым по прозрачности может удвоить разницу канала
+        if first_band.shape[2] == 4:
+            block_diff *= 2
+        failed = self.YIQ_CHANNEL_BOUND * block_diff ** 2 > max_delta
+        self._update_stats(Counter(prefiltered_blocks=int(len(failed) - failed.sum())))
+
+        width = first_band.shape[1]
+        candidates = np.nonzero(failed)[0]
+        # непрерывные отрезки подозрительных блоков считаем одним срезом
+        for run in np.split(candidates, np.nonzero(np.diff(candidates) > 1)[0] + 1):
+            if not len(run):
+                continue
+            left, right = int(run[0]) * self._block_width, min((int(run[-1]) + 1) * self._block_width, width)
+            mismatch = self._yiq_delta(first_band[:, left:right], second_band[:, left:right]) > max_delta
+            if self._detect_antialiasing and mismatch.any():
+                ys, xs = np.nonzero(mismatch)
+                failed[run] = self._find_real_mismatch(
+                    first, second, ys + top, xs + left, xs // self._block_width, len(run)
+                )
+            else:
+                failed[run] = self._pool_blocks(mismatch, np.any)[:len(run)]
+
+        return failed
+
+    def _count_blocks(self, width: int, height: int) -> int:
+        return -(-width // self._block_width) * -(-height // self._block_height)
+
+    def _compare_blocks(
+        self,
+        first_image: Image.Image,
+        second_image: Image.Image,
+        second_digests: Optional[List[bytes]] = None,
+        comparison: Optional[str] = None,
+        split_rows: bool = True
+    ) -> Tuple[int, List[Box]]:
+        if comparison is not None:
+            self._check_comparison(self._engine, comparison)
+        width, height = first_image.size
+        with timings.span("compare", pixels=width * height):
+            if self._engine == self.ENGINE_REFERENCE:
+                return self._compare_blocks_reference(first_image, second_image)
+            return self._compare_blocks_vectorized(first_image, second_image, second_digests, comparison, split_rows)
+
+    def _group_blocks(self, boxes: List[Box]) -> List[List[Box]]:
+        """Разбить битые блоки на связные группы: блоки соседние, если касаются сторонами или углами"""
+        cells = {(box[1] // self._block_height, box[0] // self._block_width): box for box in boxes}
+        groups = []
+        seen = set()
+        for cell in cells:
+            if cell in seen:
+                continue
+            seen.add(cell)
+            group, stack = [], [cell]
+            while stack:
+                row, col = stack.pop()
+                group.append(cells[row, col])
+                for neighbour in ((row + dy, col + dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)):
+                    if neighbour in cells and neighbour not in seen:
+                        seen.add(neighbour)
+                        stack.append(neighbour)
+            groups.append(sorted(group, key=lambda box: (box[1], box[0])))
+
+        return sorted(groups, key=lambda group: (group[0][1], group[0][0]))
+
+    @staticmethod
+    def _max_delta(first_image: Image.Image, second_image: Image.Image, box: Box) -> int:
+        """Максимальная разница по каналам в прямоугольнике"""
+        mode = first_image.mode if first_image.mode == second_image.mode and first_image.mode in ("RGB", "RGBA") \
+            else "RGBA"
+        first = np.asarray(first_image.crop(box).convert(mode), dtype=np.int16)
+        second = np.asarray(second_image.crop(box).convert(mode), dtype=np.int16)
+        return int(np.abs(first - second).max())
+
+    def get_diff_regions(
+        self,
+        first_image: Image.Image,
+        second_image: Image.Image,
+        second_digests: Optional[List[bytes]] = None,
+        comparison: Optional[str] = None
+    ) -> Tuple[int, List[DiffRegion]]:
+        """Поблочно сравнить два изображения, вернуть количество битых блоков и области отличий.
+
+        Соседние битые блоки объединяются в одну область, области упорядочены сверху вниз. Блоки, которые есть только
+        в одном из изображений (если размеры разные), учитываются в количестве, но в области не попадают.
+        :param second_digests: посчитанные заранее band_digests(second_image), например, из кэша эталонов.
+        :param comparison: сравнение пикселей вместо заданного в конструкторе, например COMPARISON_PERCEPTUAL.
+        """
+        with timings.profile():
+            mistaken_blocks, boxes = self._compare_blocks(first_image, second_image, second_digests, comparison)
+            return mistaken_blocks, self._get_regions(first_image, second_image, boxes)
+
+    def _get_regions(self, first_image: Image.Image, second_image: Image.Image, boxes: List[Box]) -> List[DiffRegion]:
+        regions = []
+        for blocks in self._group_blocks(boxes):
+            box = (
+                min(block[0] for block in blocks),
+                min(block[1] for block in blocks),
+                max(block[2] for block in blocks),
+                max(block[3] for block in blocks),
+            )
+            area = (box[2] - box[0]) * (box[3] - box[1])
+            regions.append(DiffRegion(box, blocks, area, self._max_delta(first_image, second_image, box)))
+
+        return regions
+
+    def get_batch_diff_regions(
+        self,
+        pairs: List[Tuple[Image.Image, Image.Image, Optional[List[bytes]]]],
+        comparison: Optional[str] = None
+    ) -> List[Tuple[int, List[DiffRegion]]]:
+        """То же, что get_diff_regions, для нескольких пар изображений (first_image, second_image, second_digests).
+
+        При workers > 1 пары сравниваются в пуле потоков целиком: кропы элементов обычно невысокие, и делить каждый на
+        полосы нет смысла.
+        """
+        def compare(pair):
+            first_image, second_image, second_digests = pair
+            mistaken_blocks, boxes = self._compare_blocks(
+                first_image, second_image, second_digests, comparison, split_rows=False
+            )
+            return mistaken_blocks, self._get_regions(first_image, second_image, boxes)
+
+        with timings.profile():
+            if self._workers > 1 and len(pairs) > 1:
+                with ThreadPoolExecutor(self._workers) as executor:
+                    return list(executor.map(compare, pairs))
+            return [compare(pair) for pair in pairs]
+
+    @staticmethod
+    def draw_diff(image: Image.Image, regions: List[DiffRegion]) -> Image.Image:
+        """Копия изображения, на которой отмечены битые блоки"""
+        result_image = image.copy()
+        draw = ImageDraw.Draw(result_image)
+        for region in regions:
+            for box in region.blocks:
+                draw.rectangle(box, outline="red")
+
+        return result_image
+
+    @classmethod
+    def draw_diff_preview(cls, image: Image.Image, regions: List[DiffRegion], max_pixels: int) -> Image.Image:
+        """То же, что draw_diff, но изображение уменьшено в целое число раз, чтобы в нем было не больше max_pixels
+        пикселей. Блоки рисуются после уменьшения, чтобы рамки не пропали."""
+        width, height = image.size
+        factor = math.ceil(math.sqrt(width * height / max_pixels))
+        if factor <= 1:
+            return cls.draw_diff(image, regions)
+
+        result_image = image.reduce(factor)
+        draw = ImageDraw.Draw(result_image)
+        for region in regions:
+            for box in region.blocks:
+                draw.rectangle(tuple(value // factor for value in box), outline="red")
+
+        return result_image
+
+    @staticmethod
+    def draw_region(image: Image.Image, region: DiffRegion, margin: int = 20) -> Image.Image:
+        """Кроп области отличий с полями margin, на котором отмечены битые блоки"""
+        width, height = image.size
+        left, top = max(region.box[0] - margin, 0), max(region.box[1] - margin, 0)
+        crop = image.crop((left, top, min(region.box[2] + margin, width), min(region.box[3] + margin, height)))
+        draw = ImageDraw.Draw(crop)
+        for box in region.blocks:
+            draw.rectangle((box[0] - left, box[1] - top, box[2] - left, box[3] - top), outline="red")
+
+        return crop
+
+    def get_images_diff_image(
+        self,
+        first_image: Image.Image,
+        second_image: Image.Image,
+        second_digests: Optional[List[bytes]] = None,
+        comparison: Optional[str] = None
+    ) -> Tuple[int, Optional[Image.Image]]:
+        """То же, что get_images_diff, но картинка с отмеченными блоками возвращается без кодирования в png"""
+        with timings.profile():
+            mistaken_blocks, boxes = self._compare_blocks(first_image, second_image, second_digests, comparison)
+        if mistaken_blocks == 0:
+            return mistaken_blocks, None
+
+        result_image = first_image.copy()
+        draw = ImageDraw.Draw(result_image)
+        for box in boxes:
+            draw.rectangle(box, outline="red")
+
+        return mistaken_blocks, result_image
+
+    def get_images_diff(
+        self,
+        first_image: Image.Image,
+        second_image: Image.Image,
+        second_digests: Optional[List[bytes]] = None,
+        comparison: Optional[str] = None
+    ) -> List[Union[int, Optional[bytes]]]:
+        """Поблочно сравнить два изображения и вернуть количество блоков с несовпавшими пикселями.
+
+        Картинка с отмеченными блоками возвращается только если есть отличия, иначе вместо нее None.
+        :param second_digests: посчитанные заранее band_digests(second_image), например, из кэша эталонов.
+        :param comparison: сравнение пикселей вместо заданного в конструкторе, например COMPARISON_PERCEPTUAL.
+        """
+        mistaken_blocks, result_image = self.get_images_diff_image(first_image, second_image, second_digests, comparison)
+        if result_image is None:
+            return [mistaken_blocks, None]
+
         return [mistaken_blocks, self.image_to_bytes(result_image)]
 
+    def get_stats_report(self) -> str:
+        """Доля сравнений, пропущенных по совпадению хэшей, и оценка сэкономленного времени"""
+        comparisons = self.stats["comparisons"]
+        bands = self.stats["bands"]
+        identical_bands = self.stats["identical_bands"]
+        compared_bands = bands - identical_bands
+        band_time = self.stats["compare_time"] / compared_bands if compared_bands else 0
+        saved = identical_bands * band_time - self.stats["hash_time"]
+
+        return (
+            f"Image comparisons: {comparisons}, "
+            f"identical images: {self.stats['identical_images']} ({self.stats['identical_images'] / max(comparisons, 1):.0%}), "
+            f"identical block rows: {identical_bands}/{bands} ({identical_bands / max(bands, 1):.0%}), "
+            f"blocks passed by pre-filter: {self.stats['prefiltered_blocks']}, "
+            f"compare time: {self.stats['compare_time']:.3f}s, hash time: {self.stats['hash_time']:.3f}s, "
+            f"estimated time saved: {saved:.3f}s"
+        )
+
     def paste(self, screenshots: List[bytes], over_height: int) -> Image.Image:
         """Склеить массив скриншотов в одно изображение"""
         max_width = 0
@@ -163,13 +797,18 @@ class ImageProcessor(object):
     @staticmethod
     def load_image_from_bytes(data: bytes) -> Image.Image:
         """Загрузить изображение из байтовой строки."""
-        with BytesIO(data) as fp:
+        with timings.span("decode", bytes_count=len(data)) as span, BytesIO(data) as fp:
             image: Image.Image = Image.open(fp)
             image.load()
+            span.set(pixels=image.size[0] * image.size[1])
             return image
 
     @staticmethod
-    def image_to_bytes(image: Image.Image) -> bytes:
+    def image_to_bytes(image: Image.Image, compress_level: int = 6, image_format: str = "PNG") -> bytes:
+        """Закодировать изображение. compress_level -- уровень zlib для png (0-9), 6 -- как по умолчанию в Pillow."""
         with BytesIO() as fp:
-            image.save(fp, "PNG")
+            if image_format == "PNG":
+                image.save(fp, image_format, compress_level=compress_level)
+            else:
+                image.save(fp, image_format)
             return fp.getvalue()
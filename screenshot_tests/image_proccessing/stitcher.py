@@ -0,0 +1,275 @@
+import hashlib
+import logging
+import queue
+import threading
+import time
+from typing import Optional, List, NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils.timing import timings
+
+
+class Stitcher(object):
+    """Склейка кадров прокрутки страницы в одно изображение.
+
+    В отличие от ImageProcessor.paste() не доверяет рассчитанному сдвигу между кадрами: настоящий сдвиг ищется
+    сравнением хэшей строк в области перекрытия соседних кадров. Кадры декодируются по одному и сразу пишутся в заранее
+    выделенный буфер.
+    """
+
+    # Минимальное количество строк перекрытия, по которым можно судить о сдвиге
+    MIN_MATCH_ROWS = 16
+    # Доля совпавших строк, при которой сдвиг считается найденным
+    MIN_MATCH_SCORE = 0.9
+    # Какую долю ожидаемого перекрытия должно оставлять проверяемое смещение. Без этого короткое однотонное перекрытие
+    # (поля, фон) при большом смещении совпадает целиком и перебивает настоящее, в котором поменялась хоть одна строка
+    MIN_OVERLAP_RATIO = 0.5
+    # Шапка или подвал с position: fixed не может занимать больше этой доли кадра
+    MAX_FIXED_RATIO = 1 / 3
+
+    def __init__(self, height: int, mask_fixed: bool = False, search_radius: Optional[int] = None):
+        """
+        :param height: ожидаемая высота склейки, под нее заранее выделяется буфер.
+        :param mask_fixed: не повторять элементы, которые есть на одном месте в каждом кадре (шапки, плашки).
+        :param search_radius: искать сдвиг только в пределах этого количества пикселей от ожидаемого.
+        """
+        self._height = height
+        self._mask_fixed = mask_fixed
+        self._search_radius = search_radius
+
+        self._canvas: Optional[np.ndarray] = None
+        self._previous_hashes: Optional[np.ndarray] = None
+        # положение верхнего края предыдущего кадра на склейке
+        self._previous_top = 0
+        # количество заполненных строк склейки
+        self._filled = 0
+
+        self.fixed_top = 0
+        self.fixed_bottom = 0
+
+    @staticmethod
+    def _row_hashes(pixels: np.ndarray) -> np.ndarray:
+        digests = b"".join(hashlib.blake2b(row, digest_size=8).digest() for row in pixels)
+        return np.frombuffer(digests, dtype=np.uint64)
+
+    @staticmethod
+    def _same_rows_count(first: np.ndarray, second: np.ndarray) -> int:
+        """Сколько строк подряд (с начала) совпадают в двух массивах хэшей"""
+        different = np.nonzero(first != second)[0]
+        return int(different[0]) if len(different) else len(first)
+
+    def _detect_fixed(self, hashes: np.ndarray):
+        """Найти шапку и подвал: строки, которые стоят на одном и том же месте в соседних кадрах"""
+        limit = int(len(hashes) * self.MAX_FIXED_RATIO)
+        self.fixed_top = min(self._same_rows_count(self._previous_hashes, hashes), limit)
+        self.fixed_bottom = min(self._same_rows_count(self._previous_hashes[::-1], hashes[::-1]), limit)
+
+    def _find_shift(self, hashes: np.ndarray, expected_shift: int) -> int:
+        """Найти сдвиг кадра относительно предыдущего по совпадению строк в области перекрытия"""
+        frame_height = len(hashes)
+        if expected_shift + self.MIN_MATCH_ROWS > frame_height:
+            # кадры не перекрываются, сравнивать нечего
+            return expected_shift
+
+        compared_height = frame_height - self.fixed_top - self.fixed_bottom
+        min_overlap = max(self.MIN_MATCH_ROWS, int((compared_height - expected_shift) * self.MIN_OVERLAP_RATIO))
+        lowest = 1
+        highest = compared_height - min_overlap
+        if self._search_radius is not None:
+            lowest = max(lowest, expected_shift - self._search_radius)
+            highest = min(highest, expected_shift + self._search_radius)
+
+        best_shift, best_score = expected_shift, 0.0
+        for shift in range(lowest, highest + 1):
+            # строка i кадра должна совпасть со строкой shift + i предыдущего кадра, шапку и подвал не сравниваем
+            start, end = self.fixed_top, frame_height - self.fixed_bottom - shift
+            score = float(np.mean(self._previous_hashes[start + shift:end + shift] == hashes[start:end]))
+            # при равенстве выбираем сдвиг ближе к ожидаемому (однотонные строки совпадают при любом сдвиге)
+            if score > best_score or (score == best_score and abs(shift - expected_shift) < abs(best_shift - expected_shift)):
+                best_shift, best_score = shift, score
+
+        if best_score < self.MIN_MATCH_SCORE:
+            logging.info(f"Overlap not found (best score {best_score:.2f}), use expected shift {expected_shift}")
+            return expected_shift
+
+        if best_shift != expected_shift:
+            logging.info(f"Shift corrected: expected {expected_shift}, found {best_shift}")
+        return best_shift
+
+    def _ensure_canvas(self, rows: int, width: int, channels: int):
+        if self._canvas is None:
+            self._canvas = np.zeros((max(self._height, rows), width, channels), dtype=np.uint8)
+        elif rows > self._canvas.shape[0]:
+            logging.info(f"Stitched image is higher than expected: {rows} > {self._canvas.shape[0]}")
+            extra = np.zeros((rows - self._canvas.shape[0],) + self._canvas.shape[1:], dtype=np.uint8)
+            self._canvas = np.concatenate((self._canvas, extra))
+
+    @staticmethod
+    def decode(screenshot: bytes) -> np.ndarray:
+        """Декодировать png кадра в массив (height, width, 3)"""
+        return np.asarray(ImageProcessor.load_image_from_bytes(screenshot).convert("RGB"))
+
+    def add(self, screenshot: bytes, expected_shift: int) -> int:
+        """Декодировать кадр и добавить к склейке, вернуть найденный сдвиг относительно предыдущего кадра.
+
+        :param screenshot: png кадра.
+        :param expected_shift: на сколько пикселей прокрутилась страница с предыдущего кадра.
+        """
+        return self.add_frame(self.decode(screenshot), expected_shift)
+
+    def add_frame(self, pixels: np.ndarray, expected_shift: int) -> int:
+        """Добавить декодированный кадр к склейке, вернуть найденный сдвиг относительно предыдущего кадра."""
+        with timings.span("stitch", pixels=pixels.shape[0] * pixels.shape[1]):
+            return self._add_frame(pixels, expected_shift)
+
+    def _add_frame(self, pixels: np.ndarray, expected_shift: int) -> int:
+        frame_height, width = pixels.shape[:2]
+        hashes = self._row_hashes(pixels)
+
+        if self._canvas is None:
+            self._ensure_canvas(frame_height, width, pixels.shape[2])
+            self._canvas[:frame_height] = pixels
+            self._previous_hashes = hashes
+            self._filled = frame_height
+            return 0
+
+        assert width == self._canvas.shape[1], f"Кадры должны быть одинаковой ширины: {width} {self._canvas.shape[1]}"
+        if expected_shift <= 0:
+            # страница не прокрутилась, кадр ничего не добавляет
+            return 0
+
+        same_height = frame_height == len(self._previous_hashes)
+        if self._mask_fixed and same_height:
+            self._detect_fixed(hashes)
+        shift = self._find_shift(hashes, expected_shift) if same_height else expected_shift
+
+        # пишем только новые строки кадра; при маскировке еще и строки, которые в предыдущем кадре закрывал подвал,
+        # но не те, что закрывает шапка этого кадра
+        start = max(frame_height - shift, 0)
+        if self._mask_fixed:
+            start = min(max(self.fixed_top, start - self.fixed_bottom), start)
+
+        top = self._previous_top + shift
+        self._ensure_canvas(top + frame_height, width, pixels.shape[2])
+        self._canvas[top + start:top + frame_height] = pixels[start:]
+
+        self._previous_hashes = hashes
+        self._previous_top = top
+        self._filled = max(self._filled, top + frame_height)
+        return shift
+
+    def result(self) -> Image.Image:
+        """Склеенное изображение"""
+        assert self._canvas is not None, "Не добавлено ни одного кадра"
+        logging.info(f"Screen size: ({self._canvas.shape[1]}, {self._filled}), "
+                     f"fixed top: {self.fixed_top}, fixed bottom: {self.fixed_bottom}")
+        return Image.fromarray(self._canvas[:self._filled])
+
+
+class FrameTiming(NamedTuple):
+    """Время обработки одного кадра в StitchingPipeline, в секундах"""
+    index: int
+    # снятие скриншота браузером (запрос к драйверу)
+    capture: float
+    # ожидание, пока фоновый поток освободится от предыдущего кадра
+    wait: float
+    decode: float
+    stitch: float
+
+
+class StitchingPipeline(object):
+    """Склейка в фоновом потоке.
+
+    Пока браузер прокручивает страницу к следующему кадру, предыдущий кадр декодируется и пишется в склейку. В очереди
+    не больше одного кадра, поэтому в памяти одновременно буфер склейки, декодируемый кадр и png следующего.
+
+        with StitchingPipeline(Stitcher(height)) as pipeline:
+            pipeline.submit(png, shift, capture_time)
+        image = pipeline.result()
+    """
+
+    def __init__(self, stitcher: Stitcher):
+        self._stitcher = stitcher
+        self._queue = queue.Queue(maxsize=1)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        # время по кадрам: из фонового потока (index, capture, decode, stitch) и ожидание очереди из потока теста
+        self._timings = []
+        self._waits = []
+        # заполняется в close()
+        self.timings: List[FrameTiming] = []
+
+        self._thread = threading.Thread(target=self._run, name="stitching-pipeline", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        index = 0
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # после ошибки только вычитываем очередь, чтобы не заблокировать submit()
+            if self._error is not None:
+                continue
+
+            screenshot, expected_shift, capture = item
+            try:
+                started = time.perf_counter()
+                pixels = self._stitcher.decode(screenshot)
+                decoded = time.perf_counter()
+                self._stitcher.add_frame(pixels, expected_shift)
+                self._timings.append((index, capture, decoded - started, time.perf_counter() - decoded))
+            except BaseException as error:  # ошибка пробрасывается в поток теста из submit() или close()
+                self._error = error
+            index += 1
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, screenshot: bytes, expected_shift: int, capture_time: float = 0.0):
+        """Поставить кадр в очередь на склейку.
+
+        :param screenshot: png кадра.
+        :param expected_shift: на сколько пикселей прокрутилась страница с предыдущего кадра.
+        :param capture_time: сколько времени снимался кадр, для отчета.
+        """
+        assert not self._closed, "Склейка уже завершена"
+        self._raise_error()
+        started = time.perf_counter()
+        # блокируется, пока фоновый поток не заберет предыдущий кадр
+        self._queue.put((screenshot, expected_shift, capture_time))
+        self._waits.append(time.perf_counter() - started)
+
+    def close(self):
+        """Дождаться склейки всех кадров."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            self.timings = [
+                FrameTiming(index, capture, self._waits[index], decode, stitch)
+                for index, capture, decode, stitch in self._timings
+            ]
+            for timing in self.timings:
+                logging.info(f"Frame {timing.index}: capture {timing.capture:.3f}s, wait {timing.wait:.3f}s, "
+                             f"decode {timing.decode:.3f}s, stitch {timing.stitch:.3f}s")
+        self._raise_error()
+
+    def result(self) -> Image.Image:
+        """Дождаться склейки всех кадров и вернуть изображение."""
+        self.close()
+        capture = sum(timing.capture for timing in self.timings)
+        background = sum(timing.decode + timing.stitch for timing in self.timings)
+        logging.info(f"Stitched {len(self.timings)} frames: capture {capture:.3f}s, "
+                     f"decode and stitch {background:.3f}s in background")
+        return self._stitcher.result()
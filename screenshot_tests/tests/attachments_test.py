@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+
+import allure
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils.attachments import AttachmentWriter
+
+
+class TestAttachmentWriter:
+
+    def test_flush_in_order(self, monkeypatch):
+        attached = []
+        monkeypatch.setattr(allure, "attach", lambda body, name, attachment_type: attached.append((name, attachment_type, body)))
+        writer = AttachmentWriter(fast_format_pixels=50 * 50)
+        writer.attach_image(Image.new("RGB", (40, 40), "red"), "actual")
+        writer.attach_image(Image.new("RGB", (100, 100), "blue"), "expected")
+        assert attached == []
+
+        writer.close()
+        assert [(name, attachment_type) for name, attachment_type, _ in attached] == [
+            ("actual", allure.attachment_type.PNG),
+            ("expected", allure.attachment_type.BMP),
+        ]
+        assert ImageProcessor.load_image_from_bytes(attached[0][2]).getpixel((0, 0)) == (255, 0, 0)
+
+    def test_steps(self, monkeypatch):
+        attached = []
+
+        @contextmanager
+        def step(title):
+            attached.append(("step", title))
+            yield
+            attached.append(("end", title))
+
+        monkeypatch.setattr(allure, "attach", lambda body, name, attachment_type: attached.append(("attach", name)))
+        monkeypatch.setattr(allure, "step", step)
+        writer = AttachmentWriter()
+        image = Image.new("RGB", (10, 10), "red")
+        writer.attach_image(image, "actual", "first")
+        writer.attach_image(image, "actual", "second")
+        writer.attach_image(image, "diff", "first")
+        writer.attach_json([], "elements")
+
+        writer.close()
+        # вложения одного шага собираются вместе, даже если добавлялись вперемешку
+        assert attached == [
+            ("step", "first"), ("attach", "actual"), ("attach", "diff"), ("end", "first"),
+            ("step", "second"), ("attach", "actual"), ("end", "second"),
+            ("attach", "elements"),
+        ]
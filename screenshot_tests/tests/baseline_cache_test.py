@@ -0,0 +1,49 @@
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from screenshot_tests.utils.baseline_cache import BaselineStore
+
+
+def make_image(seed=0) -> Image.Image:
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 256, (50, 40, 3), dtype=np.uint8))
+
+
+class TestBaselineStore:
+
+    def test_put_and_get(self, tmp_path):
+        store = BaselineStore(str(tmp_path))
+        key = store.make_key("https://go.mail.ru/", ("xpath", "//body"), (1425, 2900), 1)
+        image = make_image()
+        store.put(key, image, [b"digest"])
+
+        baseline = store.get(key)
+        assert np.array_equal(np.asarray(baseline.image), np.asarray(image))
+        assert baseline.digests == [b"digest"]
+        assert store.get(store.make_key("https://go.mail.ru/", ("xpath", "//body"), (1425, 2900), 2)) is None
+
+    def test_freshness(self, tmp_path):
+        key = "key"
+        BaselineStore(str(tmp_path), build_id="1").put(key, make_image(), [])
+        assert BaselineStore(str(tmp_path), build_id="1").get(key) is not None
+        assert BaselineStore(str(tmp_path), build_id="2").get(key) is None
+        assert BaselineStore(str(tmp_path), ttl=0).get(key) is None
+        assert BaselineStore(str(tmp_path), invalidate_before=time.time() + 1).get(key) is None
+
+    def test_eviction(self, tmp_path):
+        store = BaselineStore(str(tmp_path))
+        store.put("first", make_image(1), [])
+        size = (tmp_path / "first.npz").stat().st_size
+        store.max_bytes = size * 2 + 100
+        store.put("second", make_image(2), [])
+        # Время изменения файлов грубое, поэтому оба эталона отодвигаем в прошлое явно
+        for key in ("first", "second"):
+            os.utime(str(tmp_path / f"{key}.npz"), (1000, 1000))
+        # "first" читали последним, поэтому вытесняется "second"
+        store.get("first")
+        store.put("third", make_image(3), [])
+        assert store.get("first") is not None
+        assert store.get("second") is None
+        assert store.get("third") is not None
@@ -0,0 +1,95 @@
+from screenshot_tests.utils.driver_pool import CLEAR_STORAGE_SCRIPT, DriverPool
+
+
+class FakeDriver:
+
+    def __init__(self):
+        self.alive = True
+        self.quit_called = False
+        self.window_size = (800, 600)
+        self.current_url = "about:blank"
+
+    def get_window_size(self):
+        return {"width": self.window_size[0], "height": self.window_size[1]}
+
+    def set_window_size(self, width, height):
+        self.window_size = (width, height)
+
+    def execute_script(self, script, *args):
+        if not self.alive:
+            raise RuntimeError("session deleted")
+        return 1
+
+    def delete_all_cookies(self):
+        pass
+
+    def get(self, url):
+        self.current_url = url
+
+    def quit(self):
+        self.quit_called = True
+
+
+class StorageDriver(FakeDriver):
+    """Хранит localStorage по origins, как браузер: скрипт чистит хранилище только текущей страницы"""
+
+    def __init__(self):
+        super().__init__()
+        self.storage = {}
+
+    def visit(self, origin):
+        self.get(f"{origin}/page")
+        self.storage[origin] = {"key": "value"}
+
+    def execute_script(self, script, *args):
+        if script == CLEAR_STORAGE_SCRIPT:
+            self.storage.pop(DriverPool._origin(self.current_url), None)
+        return super().execute_script(script, *args)
+
+
+class CdpDriver(StorageDriver):
+
+    def execute_cdp_cmd(self, command, params):
+        if command == "Storage.clearDataForOrigin":
+            self.storage.pop(params["origin"], None)
+
+
+ORIGINS = ("https://go.mail.ru/", "https://staging.go.mail.ru/")
+
+
+class TestDriverPool:
+
+    def test_reuse_and_reset(self):
+        pool = DriverPool(FakeDriver)
+        driver = pool.acquire()
+        driver.set_window_size(1425, 2900)
+        pool.release(driver)
+        assert pool.acquire() is driver
+        assert driver.window_size == (800, 600)
+
+    def test_recycle_after_max_uses(self):
+        pool = DriverPool(FakeDriver, max_uses=2)
+        driver = pool.acquire()
+        pool.release(driver)
+        assert pool.acquire() is driver
+        pool.release(driver)
+        assert driver.quit_called
+        assert pool.acquire() is not driver
+
+    def test_dead_driver_is_replaced(self):
+        pool = DriverPool(FakeDriver)
+        driver = pool.acquire()
+        pool.release(driver)
+        driver.alive = False
+        assert pool.acquire() is not driver
+        assert driver.quit_called
+
+    def test_reset_visited_origins(self):
+        for factory in (StorageDriver, CdpDriver):
+            pool = DriverPool(factory, origins=ORIGINS)
+            driver = pool.acquire()
+            driver.visit("https://go.mail.ru")
+            driver.visit("https://staging.go.mail.ru")
+            pool.release(driver)
+            assert driver.storage == {}
+            assert driver.current_url == "about:blank"
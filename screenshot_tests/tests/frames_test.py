@@ -0,0 +1,115 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils import replay
+from screenshot_tests.utils.frames import FrameRecorder, FrameSet, load_archive
+
+WIDTH, VIEWPORT = 60, 300
+ELEMENT = (10, 400, 50, 700)
+
+
+def make_page(height, seed=0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, (height, WIDTH, 3), dtype=np.uint8)
+
+
+def record_stitch(page, positions) -> FrameSet:
+    """Кадры, как их записывает TestCase._stitch_viewports"""
+    frame_set = FrameSet()
+    frame_set.height = len(page)
+    previous = 0
+    for position in positions:
+        frame = ImageProcessor.image_to_bytes(Image.fromarray(page[position:position + VIEWPORT]))
+        frame_set.add(FrameSet.METHOD_STITCH, frame, position - previous)
+        previous = position
+    frame_set.crops = [ELEMENT]
+    return frame_set
+
+
+def save(root, page, changed_page, check=1) -> str:
+    positions = [0, 225, 450, 675, 700]
+    settings = ImageProcessor().settings()
+    return FrameRecorder(root).save(
+        "tests/page_test.py::TestPage::test_element", check,
+        record_stitch(changed_page, positions), record_stitch(page, positions),
+        {"elements": [["css selector", ".element"]], "diffs": [7], "settings": settings},
+    )
+
+
+class TestFrameSet:
+
+    def test_stitch(self):
+        page = make_page(1000)
+        image, = record_stitch(page, [0, 225, 450, 675, 700]).rebuild(ImageProcessor())
+        assert np.array_equal(np.asarray(image), page[400:700, 10:50])
+
+    def test_paste(self):
+        page = make_page(900)
+        frame_set = FrameSet()
+        for position in (0, 300, 600, 600):
+            frame_set.add(FrameSet.METHOD_PASTE, ImageProcessor.image_to_bytes(Image.fromarray(
+                page[position:position + VIEWPORT]
+            )))
+        # последний кадр целиком повторяет предыдущий
+        frame_set.over_height = VIEWPORT
+        frame_set.crops = [None, ELEMENT]
+
+        page_image, element_image = frame_set.rebuild(ImageProcessor())
+        assert np.array_equal(np.asarray(page_image), page)
+        assert np.array_equal(np.asarray(element_image), page[400:700, 10:50])
+
+    def test_from_images(self):
+        images = [Image.fromarray(make_page(50, seed)) for seed in range(2)]
+        rebuilt = FrameSet.from_images(images).rebuild(ImageProcessor())
+        assert [np.asarray(image).tolist() for image in rebuilt] == [np.asarray(image).tolist() for image in images]
+
+
+class TestRecorder:
+
+    def test_round_trip(self, tmp_path):
+        page = make_page(1000)
+        path = save(str(tmp_path), page, page)
+        assert os.path.basename(path) == "tests_page_test.py_TestPage_test_element-1.zip"
+
+        meta, actual, expected = load_archive(path)
+        assert meta["test_id"] == "tests/page_test.py::TestPage::test_element"
+        assert meta["diffs"] == [7]
+        assert actual.to_meta() == record_stitch(page, [0, 225, 450, 675, 700]).to_meta()
+        assert expected.frames == record_stitch(page, [0, 225, 450, 675, 700]).frames
+
+
+class TestReplay:
+
+    def test_replay(self, tmp_path):
+        page = make_page(1000)
+        changed = page.copy()
+        changed[500:510, 20:30] = (changed[500:510, 20:30].astype(np.int16) + 50) % 256
+
+        same = replay.replay_archive(save(str(tmp_path), page, page))
+        assert same["elements"] == [{"element": ["css selector", ".element"], "recorded": 7, "diff": 0, "regions": 0}]
+
+        path = save(str(tmp_path), page, changed, check=2)
+        assert replay.replay_archive(path)["elements"][0]["diff"] == 1
+        assert replay.replay_archive(path, replay.ReplayOptions(tolerance=255))["elements"][0]["diff"] == 0
+        assert replay.replay_archive(path, replay.ReplayOptions(block_size=5))["elements"][0]["diff"] == 4
+
+    def test_main(self, tmp_path):
+        page = make_page(1000)
+        changed = page.copy()
+        changed[500:510, 20:30] = 255 - changed[500:510, 20:30]
+        frames = tmp_path / "frames"
+        save(str(frames), page, page, check=1)
+        save(str(frames), page, changed, check=2)
+
+        output = tmp_path / "replay.json"
+        diffs = tmp_path / "diffs"
+        code = replay.main([str(frames), "--processes", "2", "--output", str(output), "--diff_dir", str(diffs)])
+
+        assert code == 1
+        results = json.loads(output.read_text())
+        assert [result["check"] for result in results] == [1, 2]
+        assert [result["elements"][0]["diff"] for result in results] == [0, 1]
+        assert os.listdir(str(diffs)) == ["tests_page_test.py_TestPage_test_element-2-0.png"]
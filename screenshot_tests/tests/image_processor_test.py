@@ -0,0 +1,232 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+
+
+def make_image(width, height, mode="RGB", seed=0) -> Image.Image:
+    channels = len(mode)
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, channels), dtype=np.uint8)
+    return Image.fromarray(pixels, mode)
+
+
+def change_pixels(image: Image.Image, points, delta) -> Image.Image:
+    pixels = np.array(image).astype(np.int16)
+    for x, y in points:
+        pixels[y, x] = (pixels[y, x] + delta) % 256
+    return Image.fromarray(pixels.astype(np.uint8), image.mode)
+
+
+class TestImageProcessorEngines:
+    """Векторизованное сравнение должно давать тот же результат, что и попиксельное."""
+
+    @staticmethod
+    def assert_engines_equal(first_image, second_image):
+        reference = ImageProcessor(ImageProcessor.ENGINE_REFERENCE).get_images_diff(first_image, second_image)
+        vectorized = ImageProcessor(ImageProcessor.ENGINE_VECTORIZED).get_images_diff(first_image, second_image)
+        assert vectorized == reference
+        return vectorized[0]
+
+    @pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+    def test_identical(self, mode):
+        image = make_image(130, 90, mode)
+        assert self.assert_engines_equal(image, image.copy()) == 0
+
+    def test_within_tolerance(self):
+        image = make_image(130, 90)
+        pixels = np.array(image).astype(np.int16)
+        noisy = np.clip(pixels + np.random.default_rng(1).integers(-31, 32, pixels.shape), 0, 255).astype(np.uint8)
+        assert self.assert_engines_equal(image, Image.fromarray(noisy, "RGB")) == 0
+
+    @pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+    def test_changed_blocks(self, mode):
+        image = make_image(130, 90, mode)
+        changed = change_pixels(image, [(0, 0), (45, 10), (129, 89), (100, 41)], 100)
+        assert self.assert_engines_equal(image, changed) == 4
+
+    def test_difference_equal_to_tolerance(self):
+        image = Image.new("RGB", (80, 40), (100, 100, 100))
+        changed = Image.new("RGB", (80, 40), (100, 100, 100 + ImageProcessor.tolerance[ImageProcessor.BLUE]))
+        assert self.assert_engines_equal(image, changed) == 2
+
+    def test_different_height(self):
+        image = make_image(130, 80)
+        taller = Image.new("RGB", (130, 120))
+        taller.paste(change_pixels(image, [(50, 50)], 100), (0, 0))
+        assert self.assert_engines_equal(image, taller) == 5
+        assert self.assert_engines_equal(taller, image) == 5
+
+
+class TestImageProcessorShortcuts:
+    """Пропуск сравнения по хэшам."""
+
+    def test_identical_images_skip_comparison(self):
+        processor = ImageProcessor()
+        image = make_image(130, 90)
+        assert processor.get_images_diff(image, image.copy()) == [0, None]
+        assert processor.stats["identical_images"] == 1
+        assert processor.stats["compare_time"] == 0
+
+    def test_identical_rows_skipped(self):
+        processor = ImageProcessor()
+        image = make_image(130, 130)
+        diff, result = processor.get_images_diff(image, change_pixels(image, [(50, 50)], 100))
+        assert diff == 1
+        assert result is not None
+        assert processor.stats["bands"] == 4
+        assert processor.stats["identical_bands"] == 3
+        assert "identical block rows: 3/4 (75%)" in processor.get_stats_report()
+
+    @pytest.mark.parametrize("workers", [2, 3, 8])
+    def test_parallel_strips(self, workers):
+        image = make_image(130, 410)
+        changed = change_pixels(image, [(0, 0), (45, 200), (129, 409), (100, 241)], 100)
+        assert ImageProcessor(workers=workers).get_images_diff(image, changed) == \
+            ImageProcessor().get_images_diff(image, changed)
+
+
+class TestDiffRegions:
+
+    def test_no_regions(self):
+        image = make_image(130, 90)
+        assert ImageProcessor().get_diff_regions(image, image.copy()) == (0, [])
+
+    @pytest.mark.parametrize("engine", [ImageProcessor.ENGINE_REFERENCE, ImageProcessor.ENGINE_VECTORIZED])
+    def test_adjacent_blocks_merged(self, engine):
+        image = Image.new("RGB", (200, 200), "gray")
+        # блоки (0, 0), (1, 1) касаются углами, (4, 4) отдельно
+        changed = change_pixels(image, [(39, 39), (40, 40), (190, 190)], 100)
+        diff, regions = ImageProcessor(engine).get_diff_regions(image, changed)
+
+        assert diff == 3
+        assert [region.box for region in regions] == [(0, 0, 80, 80), (160, 160, 200, 200)]
+        assert [len(region.blocks) for region in regions] == [2, 1]
+        assert [region.area for region in regions] == [80 * 80, 40 * 40]
+        assert [region.max_delta for region in regions] == [100, 100]
+
+    def test_region_crop(self):
+        image = Image.new("RGB", (200, 200), "white")
+        _, [region] = ImageProcessor().get_diff_regions(image, change_pixels(image, [(100, 100)], 50))
+        crop = ImageProcessor.draw_region(image, region, margin=20)
+
+        assert region.box == (80, 80, 120, 120)
+        assert crop.size == (80, 80)
+        assert crop.getpixel((20, 20)) == (255, 0, 0)
+        assert crop.getpixel((0, 0)) == (255, 255, 255)
+
+    def test_diff_preview(self):
+        image = Image.new("RGB", (400, 400), "white")
+        _, regions = ImageProcessor().get_diff_regions(image, change_pixels(image, [(100, 100)], 50))
+        preview = ImageProcessor.draw_diff_preview(image, regions, 100 * 100)
+
+        assert preview.size == (100, 100)
+        # блок (80, 80, 120, 120) уменьшен в 4 раза
+        assert preview.getpixel((20, 20)) == (255, 0, 0)
+        assert ImageProcessor.draw_diff_preview(image, regions, 400 * 400).size == (400, 400)
+
+
+class TestPerceptualComparison:
+
+    @staticmethod
+    def make_line(edge) -> Image.Image:
+        """Черная вертикальная линия на белом фоне, edge -- цвет колонки справа от нее"""
+        pixels = np.full((80, 80, 3), 255, dtype=np.uint8)
+        pixels[:, 20:22] = 0
+        pixels[:, 22] = edge
+        return Image.fromarray(pixels, "RGB")
+
+    def test_identical(self):
+        image = make_image(130, 90)
+        assert ImageProcessor(comparison=ImageProcessor.COMPARISON_PERCEPTUAL).get_images_diff(image, image.copy()) \
+            == [0, None]
+
+    def test_antialiasing_ignored(self):
+        image, shifted = self.make_line(255), self.make_line(128)
+        assert ImageProcessor().get_images_diff(image, shifted)[0] == 2
+        assert ImageProcessor().get_images_diff(image, shifted, comparison=ImageProcessor.COMPARISON_PERCEPTUAL)[0] == 0
+
+    def test_antialiasing_detection_disabled(self):
+        processor = ImageProcessor(comparison=ImageProcessor.COMPARISON_PERCEPTUAL, detect_antialiasing=False)
+        assert processor.get_images_diff(self.make_line(255), self.make_line(128))[0] == 2
+
+    @pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+    def test_changed_blocks(self, mode):
+        image = make_image(130, 90, mode)
+        changed = change_pixels(image, [(0, 0), (45, 10), (129, 89), (100, 41)], 100)
+        processor = ImageProcessor(comparison=ImageProcessor.COMPARISON_PERCEPTUAL)
+        assert processor.get_images_diff(image, changed)[0] == 4
+
+    def test_prefilter(self):
+        image = make_image(130, 90)
+        pixels = np.array(image).astype(np.int16)
+        noisy = np.clip(pixels + np.random.default_rng(1).integers(-5, 6, pixels.shape), 0, 255).astype(np.uint8)
+        processor = ImageProcessor(comparison=ImageProcessor.COMPARISON_PERCEPTUAL)
+
+        assert processor.get_images_diff(image, Image.fromarray(noisy, "RGB"))[0] == 0
+        assert processor.stats["prefiltered_blocks"] == 12
+
+    def test_reference_engine_not_supported(self):
+        with pytest.raises(AssertionError):
+            ImageProcessor(ImageProcessor.ENGINE_REFERENCE, comparison=ImageProcessor.COMPARISON_PERCEPTUAL)
+
+
+def antialiased_line(offset: float, size: int = 48) -> Image.Image:
+    """Наклонная черная линия со сглаженными краями на белом фоне, offset -- положение по x в первой строке"""
+    y, x = np.mgrid[0:size, 0:size]
+    value = np.clip(np.abs(x - (y * 0.6 + offset)) - 0.5, 0, 1) * 255
+    return Image.fromarray(np.repeat(np.round(value).astype(np.uint8)[:, :, None], 3, axis=2), "RGB")
+
+
+def texture(size: int = 48) -> Image.Image:
+    y, x = np.mgrid[0:size, 0:size]
+    pixels = np.stack([(x * 37 + y * 11) % 256, (x * 5 + y * 23) % 256, (x * y) % 256], axis=2)
+    return Image.fromarray(pixels.astype(np.uint8), "RGB")
+
+
+def patched(image: Image.Image, box, color) -> Image.Image:
+    result = image.copy()
+    result.paste(color, box)
+    return result
+
+
+def gray(size: int = 48) -> Image.Image:
+    return Image.new("RGB", (size, size), (128, 128, 128))
+
+
+class TestPixelmatchEquivalence:
+    """Количество отличающихся пикселей (блоки 1x1) совпадает с pixelmatch 5.3.0.
+
+    Эталонные значения посчитаны на этих же картинках оригинальным алгоритмом pixelmatch на node.js.
+    """
+
+    @pytest.mark.parametrize("first, second, threshold, expected", [
+        # сдвиг сглаженной линии на доли пикселя почти целиком уходит в антиалиазинг
+        (antialiased_line(10.0), antialiased_line(10.4), 0.1, 9),
+        (antialiased_line(10.0), antialiased_line(10.4), 0.05, 19),
+        (antialiased_line(10.0), antialiased_line(16.0), 0.1, 96),
+        (texture(), patched(texture(), (10, 10, 20, 20), (200, 30, 30)), 0.1, 99),
+        (gray(), patched(gray(), (5, 5, 25, 25), (158, 128, 128)), 0.1, 0),
+        (gray(), patched(gray(), (5, 5, 25, 25), (158, 128, 128)), 0.05, 400),
+        (texture(), texture().point(lambda value: min(value + 40, 255)), 0.1, 2155),
+    ], ids=["subpixel shift", "subpixel shift 0.05", "moved line", "changed block", "faint tint", "faint tint 0.05",
+            "brighter texture"])
+    def test_mismatch_count(self, first, second, threshold, expected):
+        processor = ImageProcessor(comparison=ImageProcessor.COMPARISON_PERCEPTUAL, threshold=threshold, block_size=1)
+        assert processor.get_images_diff(first, second)[0] == expected
+
+
+class TestBatchDiff:
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    def test_same_as_single(self, workers):
+        pairs = []
+        for seed in range(4):
+            image = make_image(130, 90, seed=seed)
+            pairs.append((image, change_pixels(image, [(seed * 30, seed * 20)], 100), None))
+        pairs.append((pairs[0][0], pairs[0][0].copy(), None))
+
+        processor = ImageProcessor(workers=workers)
+        expected = [ImageProcessor().get_diff_regions(first, second) for first, second, _ in pairs]
+        assert processor.get_batch_diff_regions(pairs) == expected
+        assert processor.stats["comparisons"] == len(pairs)
@@ -0,0 +1,374 @@
+import base64
+import re
+import threading
+from urllib.parse import urlparse
+
+import numpy as np
+import pytest
+from PIL import Image
+from selenium.common.exceptions import WebDriverException
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils import screenshots
+from screenshot_tests.utils.baseline_cache import BaselineStore
+from screenshot_tests.utils.frames import FrameRecorder, FrameSet
+from screenshot_tests.utils.settle import PageSettler
+
+
+class FakeDriver:
+    """Снимает прямоугольник через Page.captureScreenshot, как хром"""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.commands = []
+
+    def execute_cdp_cmd(self, command, params):
+        self.commands.append((command, params))
+        if self.error:
+            raise self.error
+        clip = params["clip"]
+        image = Image.new("RGB", (clip["width"], clip["height"]), "red")
+        return {"data": base64.b64encode(ImageProcessor.image_to_bytes(image)).decode()}
+
+
+def make_case(driver) -> screenshots.TestCase:
+    case = screenshots.TestCase()
+    case.driver = driver
+    case.image_processor = ImageProcessor()
+    return case
+
+
+class TestClipCapture:
+
+    def test_clip(self):
+        driver = FakeDriver()
+        image = make_case(driver)._capture_clip(10, 2000, 110, 2050)
+
+        assert image.size == (100, 50)
+        command, params = driver.commands[0]
+        assert command == "Page.captureScreenshot"
+        assert params["clip"] == {"x": 10, "y": 2000, "width": 100, "height": 50, "scale": 1}
+        assert params["captureBeyondViewport"]
+
+    def test_not_supported(self):
+        assert make_case(FakeDriver(WebDriverException("unknown command")))._capture_clip(0, 0, 10, 10) is None
+        assert make_case(object())._capture_clip(0, 0, 10, 10) is None
+
+    def test_record_frames(self, tmp_path):
+        case = make_case(FakeDriver())
+        case.frame_recorder = FrameRecorder(str(tmp_path))
+        case._start_frames()
+        image = case._capture_clip(10, 2000, 110, 2050)
+
+        assert case._frames.method == FrameSet.METHOD_SINGLE
+        assert case._frames.rebuild(case.image_processor)[0].tobytes() == image.tobytes()
+
+
+class FakeWriter:
+
+    def __init__(self):
+        self.names = []
+        self.images = {}
+        self.steps = []
+
+    def attach_image(self, image, name, step=None):
+        self.names.append(name)
+        self.images[name] = image
+        self.steps.append(step)
+
+    def attach_json(self, data, name, step=None):
+        self.names.append(name)
+        self.steps.append(step)
+
+
+class TestDiffAttachments:
+
+    def test_regions(self):
+        case = make_case(None)
+        case.attachment_writer = FakeWriter()
+        case.full_diff = False
+        image = Image.new("RGB", (200, 200), "gray")
+        changed = image.copy()
+        changed.putpixel((10, 10), (0, 0, 0))
+        changed.putpixel((150, 150), (0, 0, 0))
+        _, regions = case.image_processor.get_diff_regions(image, changed)
+
+        # дифф нужен screen-diff-plugin всегда, без --full_diff он уменьшен
+        case.diff_preview_pixels = 100 * 100
+        case._attach_diff(image, changed, regions)
+        assert case.attachment_writer.names == ["diff", "diff region 1", "diff region 2", "diff regions"]
+        assert case.attachment_writer.images["diff"].size == (100, 100)
+
+        case.full_diff = True
+        case.attachment_writer = FakeWriter()
+        case._attach_diff(image, changed, regions)
+        assert case.attachment_writer.names[0] == "diff"
+        assert case.attachment_writer.images["diff"].size == (200, 200)
+
+
+class FakeElement:
+
+    def __init__(self, y, x=10, width=100, height=50):
+        self.location = {"x": x, "y": y}
+        self.size = {"width": width, "height": height}
+
+    def is_displayed(self):
+        return True
+
+
+class RerenderingDriver:
+    """Пока страница успокаивается, элемент перерисовывают на новом месте"""
+
+    def __init__(self):
+        self.elements = [FakeElement(100), FakeElement(100), FakeElement(300)]
+
+    def find_element(self, by, value):
+        return self.elements.pop(0) if len(self.elements) > 1 else self.elements[0]
+
+    def execute_script(self, script, *args):
+        return {"readyState": "complete", "scrollHeight": 1000, "scrollY": 0, "pendingImages": 0,
+                "animations": 0, "element": None}
+
+
+class TestCoords:
+
+    def test_element_is_found_after_settle(self):
+        case = make_case(RerenderingDriver())
+        case.settler = PageSettler(timeout=1, poll_interval=0.01, stable_time=0.02)
+        assert case._get_raw_coords_by_locator("css selector", ".element") == (10, 300, 110, 350)
+
+
+TEST_URL = "https://test.example/page"
+STAGING = "staging.example"
+PAGE_WIDTH, VIEWPORT = 60, 300
+
+
+def make_page(height, seed=0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, (height, PAGE_WIDTH, 3), dtype=np.uint8)
+
+
+class FakeBrowser:
+    """Страница стенда -- массив пикселей: прокрутка, скриншоты вьюпорта, элементы и переходы между стендами"""
+
+    def __init__(self, pages, elements, url=TEST_URL):
+        """
+        :param pages: host стенда -> пиксели страницы.
+        :param elements: локатор -> (left, top, right, bottom) на странице.
+        """
+        self.pages = pages
+        self.elements = elements
+        self.current_url = url
+        self.window_size = (PAGE_WIDTH, VIEWPORT)
+        self.scroll_y = 0
+        self.navigations = []
+        self.screenshots = 0
+
+    @property
+    def page(self) -> np.ndarray:
+        return self.pages[urlparse(self.current_url).netloc]
+
+    def get(self, url):
+        self.navigations.append(url)
+        self.current_url = url
+        self.scroll_y = 0
+
+    def get_window_size(self):
+        return {"width": self.window_size[0], "height": self.window_size[1]}
+
+    def set_window_size(self, width, height):
+        self.window_size = (width, height)
+
+    def find_element(self, by, value):
+        left, top, right, bottom = self.elements[value]
+        return FakeElement(top, x=left, width=right - left, height=bottom - top)
+
+    def execute_script(self, script, *args):
+        viewport = self.window_size[1]
+        scroll = re.match(r"window.scrollTo\((\d+), (\d+)\)", script)
+        if scroll:
+            self.scroll_y = max(min(int(scroll.group(2)), len(self.page) - viewport), 0)
+        elif "readyState" in script:
+            return {"readyState": "complete", "scrollHeight": len(self.page), "scrollY": self.scroll_y,
+                    "pendingImages": 0, "animations": 0, "element": None}
+        elif "scrollHeight" in script:
+            return len(self.page)
+        elif "offsetWidth" in script or "clientWidth" in script:
+            return PAGE_WIDTH
+        elif "innerHeight" in script:
+            return viewport
+        elif "pageYOffset" in script:
+            return self.scroll_y
+
+    def get_screenshot_as_png(self):
+        self.screenshots += 1
+        frame = self.page[self.scroll_y:self.scroll_y + self.window_size[1]]
+        return ImageProcessor.image_to_bytes(Image.fromarray(frame), compress_level=1)
+
+
+def make_stand_case(driver, staging_driver=None, baseline_store=None) -> screenshots.TestCase:
+    """TestCase, настроенный как в screenshot_prepare, но без pytest и браузера"""
+    case = make_case(driver)
+    case.staging = STAGING
+    case.staging_driver = staging_driver
+    case.baseline_store = baseline_store
+    case.settler = PageSettler(timeout=1, poll_interval=0.001, stable_time=0.001)
+    case.autoload_time = 0.001
+    case.attachment_writer = FakeWriter()
+    case.skip_clean_attachments = False
+    case.full_diff = False
+    case.frame_recorder = None
+    case._test_id = "screenshots_test.py::test"
+    case._checks_count = 0
+    return case
+
+
+class TestBatchCheck:
+
+    ELEMENTS = {"header": (0, 20, 60, 120), "footer": (10, 600, 50, 700)}
+
+    @classmethod
+    def make_driver(cls) -> FakeBrowser:
+        page = make_page(800)
+        staging = page.copy()
+        # на стейджинге отличается только footer
+        staging[650:660, 20:30] = 255 - staging[650:660, 20:30]
+        return FakeBrowser({"test.example": page, STAGING: staging}, cls.ELEMENTS)
+
+    def test_elements(self):
+        driver = self.make_driver()
+        case = make_stand_case(driver)
+        results = case.get_diffs([(None, "header"), (None, "footer")], full_screen=False)
+
+        assert [(result.element, result.diff) for result in results] == [((None, "header"), 0), ((None, "footer"), 1)]
+        assert results[1].regions[0].box == (0, 40, 40, 80)
+        # каждый стенд снят один раз, тест вернулся на тестовый стенд
+        assert driver.navigations == [f"https://{STAGING}/page", TEST_URL]
+
+    def test_crops(self):
+        driver = self.make_driver()
+        case = make_stand_case(driver)
+        (header, _), (footer, _) = case._get_elements_screenshots([(None, "header"), (None, "footer")], None, None)[0]
+
+        page = driver.pages["test.example"]
+        assert np.array_equal(np.asarray(header), page[20:120, 0:60])
+        assert np.array_equal(np.asarray(footer), page[600:700, 10:50])
+
+    def test_attachments(self):
+        case = make_stand_case(self.make_driver())
+        case.get_diffs([(None, "header"), (None, "footer")], full_screen=False)
+
+        writer = case.attachment_writer
+        attachments = list(zip(writer.steps, writer.names))
+        # у каждого элемента в своем шаге вложения с именами, которые ждет screen-diff-plugin
+        assert attachments[:4] == [
+            ("Element header", "actual"), ("Element header", "expected"),
+            ("Element footer", "actual"), ("Element footer", "expected"),
+        ]
+        assert ("Element footer", "diff") in attachments
+        assert ("Element header", "diff") not in attachments
+        assert attachments[-1] == (None, "elements")
+
+    def test_baselines_per_element(self, tmp_path):
+        store = BaselineStore(str(tmp_path))
+        driver = self.make_driver()
+        make_stand_case(driver, baseline_store=store).get_diffs([(None, "header"), (None, "footer")], full_screen=False)
+        assert len(list(tmp_path.glob("*.npz"))) == 2
+
+        driver.navigations = []
+        results = make_stand_case(driver, baseline_store=store).get_diffs(
+            [(None, "header"), (None, "footer")], full_screen=False
+        )
+        # эталоны обоих элементов взяты из кэша, стейджинг не открывался
+        assert driver.navigations == []
+        assert [result.diff for result in results] == [0, 1]
+
+
+class TestParallelStands:
+
+    @staticmethod
+    def make_drivers():
+        pages = {"test.example": make_page(800), STAGING: make_page(800, seed=1)}
+        elements = {"header": (0, 20, 60, 120)}
+        return FakeBrowser(pages, elements), FakeBrowser(pages, elements, url="about:blank")
+
+    def test_stands_are_captured_at_the_same_time(self):
+        driver, staging_driver = self.make_drivers()
+        # оба стенда должны дойти до action одновременно, при снятии по очереди барьер сломается по таймауту
+        barrier = threading.Barrier(2, timeout=5)
+        drivers = []
+
+        def action(stand_driver):
+            drivers.append(stand_driver)
+            barrier.wait()
+
+        diff = make_stand_case(driver, staging_driver).get_diff((None, "header"), action=action, full_screen=False)
+
+        assert diff > 0
+        assert {id(stand_driver) for stand_driver in drivers} == {id(driver), id(staging_driver)}
+        # тестовый браузер не уходит со своей страницы, возвращаться не нужно
+        assert driver.navigations == []
+        assert staging_driver.navigations == [f"https://{STAGING}/page"]
+
+    def test_hook_without_driver_is_serial(self):
+        driver, staging_driver = self.make_drivers()
+        make_stand_case(driver, staging_driver).get_diff((None, "header"), action=lambda: None, full_screen=False)
+
+        assert staging_driver.navigations == []
+        assert driver.navigations == [f"https://{STAGING}/page", TEST_URL]
+
+    def test_full_screen_on_staging(self):
+        driver, staging_driver = self.make_drivers()
+        make_stand_case(driver, staging_driver).get_diff((None, "header"), full_screen=True)
+
+        assert driver.window_size == (1425, 2900)
+        assert staging_driver.window_size == (1425, 2900)
+
+
+class ClipBrowser(FakeBrowser):
+    """Хром: умеет снимать прямоугольник страницы через Page.captureScreenshot"""
+
+    def execute_cdp_cmd(self, command, params):
+        clip = params["clip"]
+        x, y = clip["x"], clip["y"]
+        frame = self.page[y:y + clip["height"], x:x + clip["width"]]
+        return {"data": base64.b64encode(ImageProcessor.image_to_bytes(Image.fromarray(frame))).decode()}
+
+
+class TestElementCapture:
+
+    ELEMENTS = {"card": (10, 500, 50, 560)}
+
+    def capture(self, driver):
+        case = make_stand_case(driver)
+        scrolls = []
+        scroll = case._scroll
+        case._scroll = lambda x, y: scrolls.append(y) or scroll(x, y)
+        image, coordinates = case._make_screenshot_element(None, "card")
+        return case, image, coordinates, scrolls
+
+    def test_clip(self):
+        page = make_page(800)
+        _, image, coordinates, _ = self.capture(ClipBrowser({"test.example": page}, self.ELEMENTS))
+
+        assert coordinates == (10, 500, 50, 560)
+        assert np.array_equal(np.asarray(image), page[500:560, 10:50])
+
+    @pytest.mark.parametrize("box, start, screenshots", [
+        # элемент целиком в первом кадре
+        ((10, 500, 50, 560), 400, 1),
+        # элемент выше вьюпорта, кадры склеиваются
+        ((10, 300, 50, 750), 200, 3),
+    ])
+    def test_strips(self, box, start, screenshots):
+        page = make_page(800)
+        driver = FakeBrowser({"test.example": page}, {"card": box})
+        case, image, coordinates, scrolls = self.capture(driver)
+
+        left, top, right, bottom = box
+        assert coordinates == box
+        assert np.array_equal(np.asarray(image), page[top:bottom, left:right])
+        # кадры начинаются за треть вьюпорта до элемента, чтобы его не закрыла фиксированная шапка
+        assert scrolls[:2] == [start, start]
+        assert driver.screenshots == screenshots
+        # ожидание, пока элемент перестанет двигаться, только при первом замере
+        assert [wait.reason for wait in case.settler.waits].count("element «card» is displayed") == 1
@@ -0,0 +1,50 @@
+from selenium.common.exceptions import StaleElementReferenceException
+
+from screenshot_tests.utils.settle import PageSettler
+
+
+class FakeDriver:
+    """Отдает заранее заданные состояния страницы, последнее повторяется"""
+
+    def __init__(self, *heights, animations=0):
+        self.heights = list(heights)
+        self.animations = animations
+
+    def execute_script(self, script, *args):
+        height = self.heights.pop(0) if len(self.heights) > 1 else self.heights[0]
+        return {"readyState": "complete", "scrollHeight": height, "scrollY": 0, "pendingImages": 0,
+                "animations": self.animations, "element": None}
+
+
+class StaleElementDriver(FakeDriver):
+    """Элемент перерисовывают: скрипт с ним падает stale_polls раз"""
+
+    def __init__(self, stale_polls):
+        super().__init__(100)
+        self.stale_polls = stale_polls
+
+    def execute_script(self, script, *args):
+        if args[0] is not None and self.stale_polls:
+            self.stale_polls -= 1
+            raise StaleElementReferenceException("element is not attached to the page document")
+        return super().execute_script(script, *args)
+
+
+class TestPageSettler:
+
+    def test_settles_when_state_stops_changing(self):
+        settler = PageSettler(timeout=2, poll_interval=0.01, stable_time=0.03)
+        elapsed = settler.wait(FakeDriver(100, 200, 300, 300), "load")
+        assert elapsed < 1
+        assert settler.waits[0].settled
+
+    def test_timeout_while_animations_run(self):
+        settler = PageSettler(timeout=0.1, poll_interval=0.01)
+        elapsed = settler.wait(FakeDriver(100, animations=1), "load")
+        assert 0.1 <= elapsed < 1
+        assert not settler.waits[0].settled
+
+    def test_stale_element(self):
+        settler = PageSettler(timeout=2, poll_interval=0.01, stable_time=0.03)
+        settler.wait(StaleElementDriver(stale_polls=3), "scroll", element=object())
+        assert settler.waits[0].settled
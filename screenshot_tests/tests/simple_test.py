@@ -29,3 +29,11 @@ class TestExample(TestCase):
             self.driver.find_element(By.XPATH, "//span[contains(text(), 'Соцсети')]").click()
 
         self.check_by_screenshot((By.CSS_SELECTOR, ".MainVerticalsNav-listItemActive"), action=action)
+
+    def test_main_page_blocks(self):
+        self.driver.get("https://go.mail.ru/")
+        # Несколько элементов одной страницы проверяются за одно снятие каждого стенда
+        self.check_by_screenshots([
+            (By.CSS_SELECTOR, ".MainVerticalsNav-listItemActive"),
+            (By.XPATH, "//*[text()='найти']"),
+        ])
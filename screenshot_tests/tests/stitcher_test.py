@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.image_proccessing.stitcher import Stitcher, StitchingPipeline
+
+WIDTH, VIEWPORT = 60, 300
+
+
+def make_page(height, seed=0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, (height, WIDTH, 3), dtype=np.uint8)
+
+
+def capture(page, position, header=None, footer=None) -> bytes:
+    """Кадр вьюпорта, прокрученного до position, с фиксированными шапкой и подвалом"""
+    frame = page[position:position + VIEWPORT].copy()
+    if header is not None:
+        frame[:len(header)] = header
+    if footer is not None:
+        frame[-len(footer):] = footer
+    return ImageProcessor.image_to_bytes(Image.fromarray(frame))
+
+
+def stitch(page, positions, shifts=None, mask_fixed=False, **kwargs):
+    stitcher = Stitcher(len(page), mask_fixed=mask_fixed)
+    previous = 0
+    for index, position in enumerate(positions):
+        expected = shifts[index] if shifts else position - previous
+        stitcher.add(capture(page, position, **kwargs), expected)
+        previous = position
+    return np.asarray(stitcher.result())
+
+
+class TestStitcher:
+
+    def test_overlapping_frames(self):
+        page = make_page(1000)
+        assert np.array_equal(stitch(page, [0, 225, 450, 675, 700]), page)
+
+    def test_wrong_expected_shift(self):
+        """Дробный pixel ratio и округления дают ошибку в пару пикселей"""
+        page = make_page(1000)
+        assert np.array_equal(stitch(page, [0, 225, 450, 675, 700], shifts=[0, 227, 224, 226, 30]), page)
+
+    def test_changed_overlap_with_plain_bands(self):
+        """Короткое однотонное перекрытие при большом сдвиге не должно перебить настоящее, в котором поменялась строка"""
+        page = make_page(525)
+        page[225:245] = 255
+        page[280:300] = 255
+        stitcher = Stitcher(len(page))
+        stitcher.add(capture(page, 0), 0)
+        # во втором кадре в области перекрытия мигнул курсор
+        frame = page[225:525].copy()
+        frame[50] = 0
+        assert stitcher.add(ImageProcessor.image_to_bytes(Image.fromarray(frame)), 225) == 225
+        assert np.array_equal(np.asarray(stitcher.result()), page)
+
+    @pytest.mark.parametrize("header_height, footer_height", [(40, 0), (40, 30), (0, 30)])
+    def test_mask_fixed(self, header_height, footer_height):
+        page = make_page(1000)
+        header = make_page(header_height, seed=1)[:header_height]
+        footer = make_page(footer_height, seed=2)[:footer_height]
+        # на склейке шапка только сверху, подвал только снизу
+        expected = page.copy()
+        expected[:header_height] = header
+        expected[len(page) - footer_height:] = footer
+
+        result = stitch(page, [0, 150, 300, 450, 600, 700], mask_fixed=True,
+                        header=header if header_height else None, footer=footer if footer_height else None)
+        assert np.array_equal(result, expected)
+
+
+class TestStitchingPipeline:
+
+    def test_background_stitching(self):
+        page = make_page(1000)
+        positions = [0, 225, 450, 675, 700]
+        with StitchingPipeline(Stitcher(len(page))) as pipeline:
+            previous = 0
+            for position in positions:
+                pipeline.submit(capture(page, position), position - previous)
+                previous = position
+
+        assert np.array_equal(np.asarray(pipeline.result()), page)
+        assert [timing.index for timing in pipeline.timings] == list(range(len(positions)))
+
+    def test_error_is_raised(self):
+        pipeline = StitchingPipeline(Stitcher(100))
+        pipeline.submit(b"not a png", 0)
+        with pytest.raises(Exception):
+            pipeline.close()
@@ -0,0 +1,41 @@
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils.timing import Span, Timings, timings
+
+
+class TestTimings:
+
+    def test_disabled(self):
+        recorder = Timings()
+        with recorder.span("capture") as span:
+            span.set(bytes_count=10)
+        assert recorder.report() == {"session": {}, "tests": {}}
+
+    def test_summary(self):
+        recorder = Timings()
+        recorder.enabled = True
+        recorder.begin_test()
+        with recorder.span("capture") as span:
+            span.set(bytes_count=10, pixels=4)
+        recorder.add(Span("capture", 0.5, 20, 6))
+        recorder.add(Span("decode", 0.1, 0, 0))
+
+        summary = recorder.end_test("test_one")
+        assert list(summary) == ["capture", "decode"]
+        assert summary["capture"]["count"] == 2
+        assert summary["capture"]["max"] == 0.5
+        assert (summary["capture"]["bytes"], summary["capture"]["pixels"]) == (30, 10)
+        assert recorder.report()["tests"] == {"test_one": summary}
+        assert recorder.report()["session"] == summary
+
+    def test_compare_span(self, monkeypatch):
+        monkeypatch.setattr(timings, "enabled", True)
+        monkeypatch.setattr(timings, "_session", [])
+        monkeypatch.setattr(timings, "_tests", {})
+        timings.begin_test()
+        image = Image.new("RGB", (100, 50))
+        ImageProcessor().get_diff_regions(image, image.copy())
+        summary = timings.end_test("test_compare_span")
+        assert summary["compare"]["count"] == 1
+        assert summary["compare"]["pixels"] == 5000
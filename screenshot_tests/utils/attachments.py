@@ -0,0 +1,88 @@
+"""Кодирование картинок для allure в фоне, вне критического пути теста."""
+
+import json
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Tuple
+
+import allure
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils.timing import timings
+
+
+class AttachmentWriter(object):
+    """Кодирует картинки в пуле потоков (Pillow отпускает GIL при кодировании) и прикрепляет их к отчету в flush().
+
+    allure.attach вызывается только из flush(), в потоке теста и в том порядке, в котором картинки добавлялись:
+    screen-diff-plugin ищет вложения actual, expected и diff. flush() вызывается хуком pytest_runtest_call из
+    conftest.py сразу после теста, пока отчет по нему еще не сформирован.
+
+    Вложения можно сгруппировать по шагам allure (step): так у нескольких элементов одного теста могут быть свои
+    actual, expected и diff. Шаги идут в порядке первого вложения в них, вложения без шага -- в отчете теста.
+    """
+
+    def __init__(self, workers: int = 2, compress_level: int = 1, fast_format_pixels: int = 0):
+        """
+        :param workers: количество потоков для кодирования.
+        :param compress_level: уровень сжатия png (0-9).
+        :param fast_format_pixels: картинки больше этого количества пикселей прикладывать в bmp (без сжатия, но
+            кодируется быстрее всего). 0 -- всегда png.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="attachments")
+        self._compress_level = compress_level
+        self._fast_format_pixels = fast_format_pixels
+        self._pending: List[Tuple[str, Future, Optional[str]]] = []
+
+    def _encode(self, image: Image.Image) -> Tuple[bytes, allure.attachment_type, float]:
+        started = time.perf_counter()
+        width, height = image.size
+        with timings.span("encode", pixels=width * height) as span:
+            if self._fast_format_pixels and width * height > self._fast_format_pixels:
+                data = ImageProcessor.image_to_bytes(image, image_format="BMP")
+                attachment_type = allure.attachment_type.BMP
+            else:
+                data = ImageProcessor.image_to_bytes(image, compress_level=self._compress_level)
+                attachment_type = allure.attachment_type.PNG
+            span.set(bytes_count=len(data))
+        return data, attachment_type, time.perf_counter() - started
+
+    def attach_image(self, image: Image.Image, name: str, step: Optional[str] = None):
+        """Поставить картинку в очередь на кодирование. Картинку после этого нельзя менять.
+
+        :param step: шаг allure, в который прикрепить картинку, None -- прямо в тест.
+        """
+        self._pending.append((name, self._executor.submit(self._encode, image), step))
+
+    @staticmethod
+    def _encode_json(data) -> Tuple[bytes, allure.attachment_type, float]:
+        started = time.perf_counter()
+        return json.dumps(data, indent=2).encode(), allure.attachment_type.JSON, time.perf_counter() - started
+
+    def attach_json(self, data, name: str, step: Optional[str] = None):
+        """Поставить данные в очередь на прикрепление в виде json, порядок с картинками сохраняется."""
+        self._pending.append((name, self._executor.submit(self._encode_json, data), step))
+
+    def flush(self):
+        """Дождаться кодирования и прикрепить все картинки к отчету."""
+        pending, self._pending = self._pending, []
+        # словарь сохраняет порядок первого вложения в каждый шаг
+        steps: Dict[Optional[str], List[Tuple[str, Future]]] = {}
+        for name, future, step in pending:
+            steps.setdefault(step, []).append((name, future))
+
+        for step, attachments in steps.items():
+            with allure.step(step) if step is not None else nullcontext():
+                for name, future in attachments:
+                    started = time.perf_counter()
+                    data, attachment_type, encode_time = future.result()
+                    logging.info(f"Attachment «{name}»: {len(data)} bytes, encoded in {encode_time:.3f}s, "
+                                 f"waited {time.perf_counter() - started:.3f}s")
+                    allure.attach(data, name, attachment_type)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
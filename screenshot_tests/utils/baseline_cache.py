@@ -0,0 +1,140 @@
+"""Кэш эталонных скриншотов стейджинга на диске, чтобы не снимать эталонный стенд на каждой проверке."""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+
+class Baseline(NamedTuple):
+    """Эталон из кэша: декодированное изображение и хэши рядов блоков (ImageProcessor.band_digests)"""
+    image: Image.Image
+    digests: List[bytes]
+
+
+class BaselineStore(object):
+    """Кэш эталонов в директории.
+
+    Каждый эталон -- один файл <key>.npz с декодированными пикселями и метаданными. Файл пишется во временный и
+    переименовывается (os.replace атомарен), поэтому параллельные воркеры pytest-xdist никогда не увидят недописанный
+    эталон или пиксели от одного снятия с хэшами от другого. Блокировок нет: если файл удалили, это просто промах кэша.
+
+    Эталон считается устаревшим, если он старше ttl, снят на другой сборке стейджинга (build_id), или снят раньше
+    invalidate_before. Если кэш больше max_bytes, удаляются эталоны, которые дольше всего не читались.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        ttl: Optional[float] = None,
+        build_id: Optional[str] = None,
+        max_bytes: int = 1024 * 1024 * 1024,
+        invalidate_before: Optional[float] = None
+    ):
+        """
+        :param root: директория кэша.
+        :param ttl: время жизни эталона в секундах, None -- без ограничения.
+        :param build_id: идентификатор сборки стейджинга, эталоны с другой сборки не используются.
+        :param max_bytes: максимальный размер кэша.
+        :param invalidate_before: не использовать эталоны, снятые раньше этого времени (time.time()).
+        """
+        self.root = root
+        self.ttl = ttl
+        self.build_id = build_id
+        self.max_bytes = max_bytes
+        self.invalidate_before = invalidate_before
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def make_key(url: str, locator, window_size, pixel_ratio, context: str = "") -> str:
+        """Ключ эталона.
+
+        :param context: все остальное, от чего зависит скриншот (например, тест, в котором выполняется action).
+        """
+        raw = json.dumps([url, list(locator), list(window_size), pixel_ratio, context])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.npz")
+
+    def _is_fresh(self, meta: dict) -> bool:
+        created = meta["created"]
+        if self.ttl is not None and time.time() - created > self.ttl:
+            return False
+        if self.invalidate_before is not None and created < self.invalidate_before:
+            return False
+        return self.build_id is None or meta.get("build_id") == self.build_id
+
+    def get(self, key: str) -> Optional[Baseline]:
+        """Эталон по ключу или None, если его нет или он устарел."""
+        try:
+            with np.load(self._path(key)) as data:
+                meta = json.loads(str(data["meta"]))
+                if not self._is_fresh(meta):
+                    logging.info(f"Baseline {key} is stale")
+                    return None
+                pixels = data["pixels"]
+            # отмечаем чтение для вытеснения
+            os.utime(self._path(key))
+        except (OSError, ValueError, KeyError) as error:
+            logging.info(f"Baseline {key} is not found: {error}")
+            return None
+
+        logging.info(f"Baseline {key} is found, created at {time.ctime(meta['created'])}")
+        return Baseline(Image.fromarray(pixels, meta["mode"]), [bytes.fromhex(digest) for digest in meta["digests"]])
+
+    def put(self, key: str, image: Image.Image, digests: List[bytes]):
+        """Сохранить эталон."""
+        meta = {
+            "created": time.time(),
+            "build_id": self.build_id,
+            "mode": image.mode,
+            "digests": [digest.hex() for digest in digests],
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                np.savez(fp, pixels=np.asarray(image), meta=np.array(json.dumps(meta)))
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        logging.info(f"Baseline {key} is saved")
+        self._evict()
+
+    def invalidate(self, key: str):
+        """Удалить эталон."""
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """Удалять эталоны, которые дольше всего не читались, пока кэш больше max_bytes."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            key, extension = os.path.splitext(name)
+            if extension != ".npz":
+                continue
+            try:
+                stat = os.stat(self._path(key))
+            except FileNotFoundError:
+                # эталон удален другим воркером
+                continue
+            entries.append((stat.st_mtime, stat.st_size, key))
+            total += stat.st_size
+
+        for used, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.info(f"Baseline {key} is evicted")
+            self.invalidate(key)
+            total -= size
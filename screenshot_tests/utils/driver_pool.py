@@ -0,0 +1,137 @@
+"""Пул прогретых браузеров, чтобы не запускать хром на каждый тест."""
+
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from selenium.webdriver.remote.webdriver import WebDriver
+
+CLEAR_STORAGE_SCRIPT = """
+try {
+    window.localStorage.clear();
+    window.sessionStorage.clear();
+} catch (e) {}
+"""
+
+
+class DriverPool(object):
+    """Пул браузеров в рамках одного процесса.
+
+    С pytest-xdist у каждого воркера свой процесс и, соответственно, свой пул (фикстура уровня session). Перед выдачей
+    браузер проверяется на живость, после возврата сбрасывается в чистое состояние: куки и хранилища (localStorage,
+    sessionStorage, а в хроме еще IndexedDB, кэш и т.д.) всех origins, которые посещают тесты, размер окна (его меняет
+    TestCase._use_full_screen), прокрутка. После max_uses выдач браузер закрывается и при следующем запросе
+    запускается новый.
+    """
+
+    def __init__(self, factory: Callable[[], WebDriver], max_uses: int = 20, origins: Iterable[str] = ()):
+        """
+        :param factory: функция, которая запускает новый браузер.
+        :param max_uses: сколько раз можно выдать один браузер.
+        :param origins: origins (scheme://host), которые посещают тесты, например тестовый и эталонный стенды.
+            Хранилища чистятся для каждого из них и для страницы, на которой браузер вернули в пул.
+        """
+        assert max_uses >= 1, f"Браузер должен выдаваться хотя бы один раз: {max_uses}"
+        self._factory = factory
+        self._max_uses = max_uses
+        self._origins = [self._origin(url) for url in origins]
+        self._idle: List[WebDriver] = []
+        # id(driver) -> количество выдач и размер окна при запуске
+        self._uses: Dict[int, int] = {}
+        self._window_sizes: Dict[int, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        self._worker = os.environ.get("PYTEST_XDIST_WORKER", "master")
+
+    def _create(self) -> WebDriver:
+        started = time.perf_counter()
+        driver = self._factory()
+        size = driver.get_window_size()
+        self._window_sizes[id(driver)] = (size["width"], size["height"])
+        self._uses[id(driver)] = 0
+        logging.info(f"[{self._worker}] Driver started in {time.perf_counter() - started:.3f}s")
+        return driver
+
+    def _quit(self, driver: WebDriver, reason: str):
+        self._uses.pop(id(driver), None)
+        self._window_sizes.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as error:
+            logging.info(f"[{self._worker}] Driver quit failed: {error}")
+        logging.info(f"[{self._worker}] Driver closed: {reason}")
+
+    @staticmethod
+    def _is_alive(driver: WebDriver) -> bool:
+        try:
+            return driver.execute_script("return 1") == 1
+        except Exception as error:
+            logging.info(f"Driver health check failed: {error}")
+            return False
+
+    @staticmethod
+    def _origin(url: str) -> Optional[str]:
+        """scheme://host адреса или None, если у адреса нет хранилищ (about:blank, data:)"""
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https"):
+            return None
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def _reset(self, driver: WebDriver):
+        """Вернуть браузер в чистое состояние."""
+        current = self._origin(driver.current_url)
+        driver.execute_script(CLEAR_STORAGE_SCRIPT)
+        driver.delete_all_cookies()
+        others = [origin for origin in self._origins if origin is not None and origin != current]
+        if hasattr(driver, "execute_cdp_cmd"):
+            # delete_all_cookies удаляет только куки текущего домена, в хроме можно почистить все
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            for origin in ([current] if current is not None else []) + others:
+                driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        else:
+            # Без Chrome DevTools хранилища и куки origin можно почистить только с его страницы
+            for origin in others:
+                driver.get(origin)
+                driver.execute_script(CLEAR_STORAGE_SCRIPT)
+                driver.delete_all_cookies()
+        driver.get("about:blank")
+        driver.set_window_size(*self._window_sizes[id(driver)])
+        driver.execute_script("window.scrollTo(0, 0)")
+
+    def acquire(self) -> WebDriver:
+        """Выдать живой браузер из пула или запустить новый."""
+        with self._lock:
+            while self._idle:
+                driver = self._idle.pop()
+                if self._is_alive(driver):
+                    break
+                self._quit(driver, "health check failed")
+            else:
+                driver = self._create()
+            self._uses[id(driver)] += 1
+        return driver
+
+    def release(self, driver: WebDriver):
+        """Вернуть браузер в пул."""
+        with self._lock:
+            uses = self._uses.get(id(driver), self._max_uses)
+            if uses >= self._max_uses:
+                self._quit(driver, f"recycled after {uses} uses")
+                return
+
+            started = time.perf_counter()
+            try:
+                self._reset(driver)
+            except Exception as error:
+                self._quit(driver, f"reset failed: {error}")
+                return
+            logging.info(f"[{self._worker}] Driver reset in {time.perf_counter() - started:.3f}s")
+            self._idle.append(driver)
+
+    def close(self):
+        """Закрыть все свободные браузеры."""
+        with self._lock:
+            while self._idle:
+                self._quit(self._idle.pop(), "pool closed")
@@ -0,0 +1,147 @@
+"""Запись снятых кадров в архив, чтобы потом пересобрать и сравнить скриншоты без браузера (см. replay.py)."""
+
+import json
+import logging
+import os
+import re
+import zipfile
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.image_proccessing.stitcher import Stitcher
+
+
+class FrameSet(object):
+    """Кадры, снятые с одного стенда за одну проверку, и все, что нужно, чтобы собрать из них скриншоты элементов."""
+
+    # склейка кадров с перекрытием через Stitcher
+    METHOD_STITCH = "stitch"
+    # склейка через ImageProcessor.paste()
+    METHOD_PASTE = "paste"
+    # один кадр (вьюпорт или clip)
+    METHOD_SINGLE = "single"
+    # готовые скриншоты элементов, по одному на элемент (эталоны из кэша)
+    METHOD_IMAGE = "image"
+
+    def __init__(self, pixel_ratio=1, mask_fixed: bool = False):
+        self.method = self.METHOD_SINGLE
+        self.frames: List[bytes] = []
+        # сдвиг каждого кадра относительно предыдущего, для METHOD_STITCH
+        self.shifts: List[int] = []
+        # ожидаемая высота склейки для METHOD_STITCH
+        self.height = 0
+        # сколько срезать с последнего кадра для METHOD_PASTE (с учетом плотности пикселей)
+        self.over_height = 0
+        self.pixel_ratio = pixel_ratio
+        self.mask_fixed = mask_fixed
+        # прямоугольники элементов на собранном изображении, None -- изображение целиком
+        self.crops: List[Optional[Tuple[float, float, float, float]]] = [None]
+
+    def add(self, method: str, screenshot: bytes, shift: int = 0):
+        self.method = method
+        self.frames.append(screenshot)
+        self.shifts.append(shift)
+
+    @classmethod
+    def from_images(cls, images: List[Image.Image], pixel_ratio=1) -> "FrameSet":
+        frame_set = cls(pixel_ratio)
+        for image in images:
+            frame_set.add(cls.METHOD_IMAGE, ImageProcessor.image_to_bytes(image, compress_level=1))
+        frame_set.crops = [None] * len(images)
+        return frame_set
+
+    def to_meta(self) -> dict:
+        return {
+            "method": self.method,
+            "frames": len(self.frames),
+            "shifts": self.shifts,
+            "height": self.height,
+            "over_height": self.over_height,
+            "pixel_ratio": self.pixel_ratio,
+            "mask_fixed": self.mask_fixed,
+            "crops": [list(crop) if crop is not None else None for crop in self.crops],
+        }
+
+    @classmethod
+    def from_meta(cls, meta: dict, frames: List[bytes]) -> "FrameSet":
+        frame_set = cls(meta["pixel_ratio"], meta["mask_fixed"])
+        frame_set.method = meta["method"]
+        frame_set.frames = frames
+        frame_set.shifts = meta["shifts"]
+        frame_set.height = meta["height"]
+        frame_set.over_height = meta["over_height"]
+        frame_set.crops = [tuple(crop) if crop is not None else None for crop in meta["crops"]]
+        return frame_set
+
+    def rebuild(
+        self,
+        processor: ImageProcessor,
+        mask_fixed: Optional[bool] = None,
+        search_radius: Optional[int] = None
+    ) -> List[Image.Image]:
+        """Собрать скриншоты элементов из кадров так же, как их собрал TestCase.
+
+        :param mask_fixed: маскировать шапки и подвалы при склейке вместо записанного значения.
+        :param search_radius: Stitcher.search_radius.
+        """
+        if self.method == self.METHOD_IMAGE:
+            return [processor.load_image_from_bytes(frame) for frame in self.frames]
+
+        if self.method == self.METHOD_STITCH:
+            stitcher = Stitcher(
+                self.height,
+                mask_fixed=self.mask_fixed if mask_fixed is None else mask_fixed,
+                search_radius=search_radius,
+            )
+            for frame, shift in zip(self.frames, self.shifts):
+                stitcher.add(frame, shift)
+            screen = stitcher.result()
+        elif self.method == self.METHOD_PASTE:
+            screen = processor.paste(self.frames, self.over_height)
+        else:
+            screen = processor.load_image_from_bytes(self.frames[0])
+
+        return [screen.crop(crop) if crop is not None else screen for crop in self.crops]
+
+
+class FrameRecorder(object):
+    """Пишет кадры проверок в директорию, по zip-архиву на проверку.
+
+    В архиве meta.json и png кадров как есть, без повторного сжатия: actual/000.png, expected/000.png, ...
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def save(self, test_id: str, check: int, actual: FrameSet, expected: FrameSet, meta: dict) -> str:
+        """Сохранить кадры проверки, вернуть путь к архиву.
+
+        :param meta: настройки сравнения и его результат, см. TestCase._record_check.
+        """
+        name = re.sub(r"[^\w.-]+", "_", test_id).strip("_")
+        path = os.path.join(self.root, f"{name}-{check}.zip")
+        meta = dict(meta, test_id=test_id, check=check, actual=actual.to_meta(), expected=expected.to_meta())
+
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+            archive.writestr("meta.json", json.dumps(meta, indent=2), zipfile.ZIP_DEFLATED)
+            for stand, frame_set in (("actual", actual), ("expected", expected)):
+                for index, frame in enumerate(frame_set.frames):
+                    archive.writestr(f"{stand}/{index:03}.png", frame)
+
+        logging.info(f"Frames are saved to {path}")
+        return path
+
+
+def load_archive(path: str) -> Tuple[dict, FrameSet, FrameSet]:
+    """Прочитать архив FrameRecorder: метаданные, кадры тестового и эталонного стендов."""
+    with zipfile.ZipFile(path) as archive:
+        meta = json.loads(archive.read("meta.json"))
+        frame_sets = []
+        for stand in ("actual", "expected"):
+            frames = [archive.read(f"{stand}/{index:03}.png") for index in range(meta[stand]["frames"])]
+            frame_sets.append(FrameSet.from_meta(meta[stand], frames))
+
+    return meta, frame_sets[0], frame_sets[1]
@@ -0,0 +1,161 @@
+"""Воспроизведение сравнений по кадрам, записанным с --record_frames, без браузера.
+
+Кадры заново склеиваются и сравниваются, в том числе с другими настройками. Архивы обрабатываются параллельно в
+отдельных процессах.
+
+    python -m screenshot_tests.utils.replay frames/ --processes 8 --tolerance 16 --output replay.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils.frames import load_archive
+
+
+class ReplayOptions(NamedTuple):
+    """Что поменять относительно записанных настроек, None -- оставить как было при записи"""
+    tolerance: Optional[int] = None
+    block_size: Optional[int] = None
+    comparison: Optional[str] = None
+    threshold: Optional[float] = None
+    mask_fixed: Optional[bool] = None
+    search_radius: Optional[int] = None
+    # куда сохранять картинки с диффом, None -- не сохранять
+    diff_dir: Optional[str] = None
+
+
+def find_archives(paths: List[str]) -> List[str]:
+    """Архивы из списка файлов и директорий (без рекурсии)."""
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            archives.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(".zip")
+            ))
+        else:
+            archives.append(path)
+    return archives
+
+
+def make_processor(settings: dict, options: ReplayOptions) -> ImageProcessor:
+    processor = ImageProcessor(
+        comparison=options.comparison or settings["comparison"],
+        threshold=settings["threshold"] if options.threshold is None else options.threshold,
+        detect_antialiasing=settings["detect_antialiasing"],
+        block_size=options.block_size or settings["block_size"],
+    )
+    processor.tolerance = settings["tolerance"] if options.tolerance is None else \
+        dict.fromkeys(settings["tolerance"], options.tolerance)
+    return processor
+
+
+def replay_archive(path: str, options: ReplayOptions = ReplayOptions()) -> dict:
+    """Склеить кадры одного архива и сравнить скриншоты элементов, вернуть записанный и новый результат."""
+    meta, actual, expected = load_archive(path)
+    processor = make_processor(meta["settings"], options)
+
+    started = time.perf_counter()
+    actual_images = actual.rebuild(processor, options.mask_fixed, options.search_radius)
+    expected_images = expected.rebuild(processor, options.mask_fixed, options.search_radius)
+    rebuilt = time.perf_counter()
+    results = processor.get_batch_diff_regions([
+        (first_image, second_image, None) for first_image, second_image in zip(actual_images, expected_images)
+    ])
+    compared = time.perf_counter()
+
+    elements = []
+    for index, (element, recorded, first_image, (diff, regions)) in enumerate(
+        zip(meta["elements"], meta["diffs"], actual_images, results)
+    ):
+        if diff and options.diff_dir:
+            name = f"{os.path.splitext(os.path.basename(path))[0]}-{index}.png"
+            processor.draw_diff(first_image, regions).save(os.path.join(options.diff_dir, name))
+        elements.append({"element": element, "recorded": recorded, "diff": diff, "regions": len(regions)})
+
+    return {
+        "archive": path,
+        "test_id": meta["test_id"],
+        "check": meta["check"],
+        "elements": elements,
+        "rebuild_time": rebuilt - started,
+        "compare_time": compared - rebuilt,
+    }
+
+
+def replay(archives: List[str], options: ReplayOptions = ReplayOptions(), processes: int = 1) -> List[dict]:
+    """Воспроизвести архивы в processes процессах, результаты в порядке архивов."""
+    if options.diff_dir:
+        os.makedirs(options.diff_dir, exist_ok=True)
+    if processes <= 1 or len(archives) <= 1:
+        return [replay_archive(path, options) for path in archives]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(replay_archive, archives, [options] * len(archives)))
+
+
+def _parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay recorded screenshot comparisons without a browser.")
+    parser.add_argument("paths", nargs="+", metavar="path", help="Frame archives or directories with them.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), metavar="num",
+                        help="Number of processes to replay archives in.")
+    parser.add_argument("--tolerance", type=int, default=None, metavar="num",
+                        help="Per channel tolerance for every channel instead of the recorded one.")
+    parser.add_argument("--block_size", type=int, default=None, metavar="px",
+                        help="Comparison block size instead of the recorded one.")
+    parser.add_argument("--comparison", default=None,
+                        choices=(ImageProcessor.COMPARISON_TOLERANCE, ImageProcessor.COMPARISON_PERCEPTUAL),
+                        help="Pixel comparison instead of the recorded one.")
+    parser.add_argument("--threshold", type=float, default=None, metavar="float",
+                        help="Perceptual threshold instead of the recorded one.")
+    parser.add_argument("--mask_fixed", default=None, choices=("yes", "no"),
+                        help="Mask fixed headers and footers when stitching instead of the recorded setting.")
+    parser.add_argument("--search_radius", type=int, default=None, metavar="px",
+                        help="Search stitching shift only within this distance from the expected one.")
+    parser.add_argument("--diff_dir", default=None, metavar="path", help="Save diff images to this directory.")
+    parser.add_argument("--output", default=None, metavar="path", help="Save results to a JSON file.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Вернет 1, если хоть один элемент отличается, как упавший тест."""
+    logging.basicConfig(level="INFO", format="%(message)s")
+    args = _parse_args(argv)
+    options = ReplayOptions(
+        tolerance=args.tolerance,
+        block_size=args.block_size,
+        comparison=args.comparison,
+        threshold=args.threshold,
+        mask_fixed=None if args.mask_fixed is None else args.mask_fixed == "yes",
+        search_radius=args.search_radius,
+        diff_dir=args.diff_dir,
+    )
+    archives = find_archives(args.paths)
+
+    started = time.perf_counter()
+    results = replay(archives, options, args.processes)
+    elapsed = time.perf_counter() - started
+
+    failed = changed = 0
+    for result in results:
+        for element in result["elements"]:
+            failed += bool(element["diff"])
+            changed += element["diff"] != element["recorded"]
+            logging.info(f"{result['test_id']}#{result['check']} {element['element'][1]}: "
+                         f"recorded {element['recorded']}, replayed {element['diff']}")
+    logging.info(f"{len(archives)} archives in {elapsed:.3f}s, {failed} elements differ, "
+                 f"{changed} results changed since recording")
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,38 @@
 """Screenshot TestCase."""
 
+import base64
+import copy
+import inspect
 import logging
 import time
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Callable, Any, Optional, List, NamedTuple
 from urllib.parse import urlparse
 
 import allure
 import pytest
 from PIL import Image
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 
-from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from conftest import Config
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor, DiffRegion
+from screenshot_tests.image_proccessing.stitcher import Stitcher, StitchingPipeline
 from screenshot_tests.utils import common
+from screenshot_tests.utils.attachments import AttachmentWriter
+from screenshot_tests.utils.frames import FrameRecorder, FrameSet
+from screenshot_tests.utils.settle import PageSettler
+from screenshot_tests.utils.timing import timings
+
+
+class ElementDiff(NamedTuple):
+    """Результат проверки одного элемента в check_by_screenshots"""
+    # tuple с типом локатора и локатором
+    element: Tuple[str, str]
+    # количество битых блоков
+    diff: int
+    regions: List[DiffRegion]
 
 
 # noinspection PyAttributeOutsideInit
@@ -24,20 +44,74 @@ class TestCase(common.TestCase):
 
     # Для мобильных устройств и хрома в режиме эмуляции плотность пикселей будет отличаться.
     pixel_ratio = 1
+    # Доля вьюпорта, на которую перекрываются соседние кадры при склейке страницы. По перекрытию ищется настоящий сдвиг
+    # между кадрами. 0 -- старая склейка через ImageProcessor.paste() кадрами без перекрытия.
+    scroll_overlap = 0.25
+    # Не повторять на склейке элементы, которые есть на одном месте в каждом кадре (шапки и плашки с position: fixed).
+    mask_fixed_elements = True
+    # Максимальное время ожидания стабильности страницы после прокрутки, в секундах.
+    scroll_settle_timeout = 1.0
+    # Сколько высота страницы должна не меняться после прокрутки до конца, чтобы считать что автоподгрузки нет.
+    autoload_time = 0.3
+    # Сколько областей отличий (самых больших) прикладывать к отчету кропами.
+    diff_regions_limit = 10
+    # До скольких пикселей уменьшается дифф всей страницы без --full_diff. Дифф прикладывается всегда: без вложений
+    # actual, expected и diff не работает screen-diff-plugin.
+    diff_preview_pixels = 1425 * 2900
+
+    # Снять всю страницу и вырезать из нее элемент
+    CAPTURE_PAGE = "page"
+    # Снять и склеить только кадры, которые пересекают элемент
+    CAPTURE_STRIPS = "strips"
+    # Снять только элемент через Page.captureScreenshot с clip (хром), иначе как CAPTURE_STRIPS
+    CAPTURE_CLIP = "clip"
+    # Как снимать элемент при scroll_and_screen=True.
+    element_capture = CAPTURE_CLIP
+
+    # Кадры текущего снятия, если включена запись (--record_frames), иначе None. Их заполняют методы снятия.
+    _frames: Optional[FrameSet] = None
 
     @pytest.fixture(autouse=True)
-    def screenshot_prepare(self):
-        self.image_processor = ImageProcessor()
+    def screenshot_prepare(self, request):
+        self.image_processor = ImageProcessor(
+            workers=request.config.getoption(Config.COMPARE_WORKERS),
+            comparison=request.config.getoption(Config.COMPARISON),
+            threshold=request.config.getoption(Config.PERCEPTUAL_THRESHOLD),
+        )
+        self.settler = PageSettler(
+            timeout=request.config.getoption(Config.SETTLE_TIMEOUT),
+            poll_interval=request.config.getoption(Config.SETTLE_POLL),
+            compare_frames=request.config.getoption(Config.SETTLE_FRAMES),
+        )
+        # Браузер для параллельного снятия эталонного стенда, см. _capture_stands_in_parallel
+        self.staging_driver = None
+        if request.config.getoption(Config.PARALLEL_STANDS):
+            self.staging_driver = request.getfixturevalue("staging_driver")
+        # Кэш эталонов стейджинга, None если выключен
+        self.baseline_store = request.getfixturevalue("baseline_store")
+        self._test_id = request.node.nodeid
+        self._checks_count = 0
+        self.attachment_writer = AttachmentWriter(
+            workers=request.config.getoption(Config.ATTACH_WORKERS),
+            compress_level=request.config.getoption(Config.ATTACH_COMPRESS_LEVEL),
+            fast_format_pixels=request.config.getoption(Config.ATTACH_FAST_FORMAT_PIXELS),
+        )
+        self.skip_clean_attachments = request.config.getoption(Config.SKIP_CLEAN_ATTACHMENTS)
+        self.full_diff = request.config.getoption(Config.FULL_DIFF)
+        # Запись кадров для воспроизведения сравнений без браузера, None если выключена
+        record_frames = request.config.getoption(Config.RECORD_FRAMES)
+        self.frame_recorder = FrameRecorder(record_frames) if record_frames else None
+        yield
+        self.attachment_writer.close()
+        logging.info(self.image_processor.get_stats_report())
 
     def _scroll(self, x: int, y: int):
         scroll_string = f"window.scrollTo({x}, {y})"
         self.driver.execute_script(scroll_string)
-        time.sleep(0.2)
         logging.info(f"Scroll to «{scroll_string}»")
+        self.settler.wait(self.driver, f"scroll to ({x}, {y})", timeout=self.scroll_settle_timeout)
 
     def _make_screenshot_whole_page(self, locator_type, query_string):
-        scroll_time = 0.2
-
         # Нужно заставить отработать все что есть с автоподгрузкой, чтобы получить настоящую длину страницы
         x, y, width, height = self._get_raw_coords_by_locator(locator_type, query_string)
         total_height = self.driver.execute_script("return document.body.parentNode.scrollHeight")
@@ -46,7 +120,9 @@ class TestCase(common.TestCase):
         while True:
             old_total_height = total_height
             self._scroll(0, total_height + 9999)
-            time.sleep(scroll_time)
+            # Даем время начаться автоподгрузке, если высота не изменится за autoload_time, считаем что ее нет
+            self.settler.wait(self.driver, "scroll to the end", timeout=self.scroll_settle_timeout,
+                              stable_time=self.autoload_time)
             total_height = self.driver.execute_script("return document.body.parentNode.scrollHeight")
             logging.info(f"new total height: {total_height}")
             logging.info(f"y: {y}")
@@ -58,14 +134,120 @@ class TestCase(common.TestCase):
         total_width = self.driver.execute_script("return document.body.offsetWidth")
         viewport_width = self.driver.execute_script("return document.body.clientWidth")
         viewport_height = self.driver.execute_script("return window.innerHeight")
-        screenshots = []
-        offset = 0
         assert viewport_width == total_width, "Ширина вьюпорта, и ширина экрана должны совпадать"
 
         self._scroll(0, 0)
+        if self.scroll_overlap:
+            return self._stitch_viewports(total_height, viewport_height, y)
+        return self._paste_viewports(total_height, viewport_height, y)
+
+    def _take_screenshot(self) -> bytes:
+        """Снять вьюпорт в png"""
+        with timings.span("capture") as span:
+            screenshot = self.driver.get_screenshot_as_png()
+            span.set(bytes_count=len(screenshot))
+        return screenshot
+
+    def _navigate(self, url: str):
+        with timings.span("navigate"):
+            self.driver.get(url)
+
+    def _get_scroll_position(self) -> float:
+        return self.driver.execute_script("return window.pageYOffset")
+
+    def _stitch_viewports(self, total_height, viewport_height, y) -> Image.Image:
+        """Снять страницу кадрами с перекрытием от текущей прокрутки и склеить их по найденному сдвигу.
+
+        Кадры декодируются и склеиваются в фоновом потоке, пока браузер прокручивает страницу к следующему кадру.
+        """
+        step = max(viewport_height - int(viewport_height * self.scroll_overlap), 1)
+        position = self._get_scroll_position()
+        height = round((total_height - position) * self.pixel_ratio)
+        stitcher = Stitcher(height, mask_fixed=self.mask_fixed_elements)
+        if self._frames is not None:
+            self._frames.height = height
+
+        with StitchingPipeline(stitcher) as pipeline:
+            shift = 0
+            while True:
+                logging.info(f"position: {position}, total height: {total_height}")
+                started = time.perf_counter()
+                screenshot = self._take_screenshot()
+                pipeline.submit(screenshot, shift, time.perf_counter() - started)
+                self._record_frame(FrameSet.METHOD_STITCH, screenshot, shift)
+                if position + viewport_height >= max(total_height, y):
+                    break
+
+                self._scroll(0, position + step)
+                new_position = self._get_scroll_position()
+                # Дальше страница не прокручивается
+                if new_position <= position:
+                    break
+                shift = round((new_position - position) * self.pixel_ratio)
+                position = new_position
+
+        self.frame_timings = pipeline.timings
+        return pipeline.result()
+
+    def _make_screenshot_element(self, locator_type, query_string) -> Tuple[Image.Image, Tuple[int, int, int, int]]:
+        """Снять только элемент, не снимая всю страницу: через clip, если драйвер умеет, иначе кадрами вокруг него."""
+        x, y, width, height = self._get_raw_coords_by_locator(locator_type, query_string)
+        viewport_height = self.driver.execute_script("return window.innerHeight")
+        # Шапка и подвал с position: fixed занимают не больше Stitcher.MAX_FIXED_RATIO кадра, поэтому кадры начинаются
+        # и заканчиваются с таким запасом, чтобы они не перекрыли элемент
+        margin = int(viewport_height * Stitcher.MAX_FIXED_RATIO)
+        self._scroll(0, max(y - margin, 0))
+        # Координаты могли поменяться, пока подгружалось содержимое вокруг элемента. Страницы после прокрутки уже
+        # дождались в _scroll, второй раз не ждем
+        x, y, width, height = self._get_raw_coords_by_locator(locator_type, query_string, settle=False)
+        coordinates = x * self.pixel_ratio, y * self.pixel_ratio, width * self.pixel_ratio, height * self.pixel_ratio
+
+        if self.element_capture == self.CAPTURE_CLIP:
+            screen = self._capture_clip(x, y, width, height)
+            if screen is not None:
+                return screen, coordinates
+
+        self._scroll(0, max(y - margin, 0))
+        start = self._get_scroll_position()
+        screen = self._stitch_viewports(height + margin, viewport_height, height + margin)
+        box = tuple(round(value * self.pixel_ratio) for value in (x, y - start, width, height - start))
+        if self._frames is not None:
+            self._frames.crops = [box]
+        return screen.crop(box), coordinates
+
+    def _capture_clip(self, x, y, width, height) -> Optional[Image.Image]:
+        """Снять прямоугольник страницы (координаты документа без учета плотности пикселей) через Chrome DevTools.
+
+        Вернет None, если драйвер этого не умеет.
+        """
+        if not hasattr(self.driver, "execute_cdp_cmd"):
+            return None
+
+        try:
+            with timings.span("capture") as span:
+                result = self.driver.execute_cdp_cmd("Page.captureScreenshot", {
+                    "format": "png",
+                    "clip": {"x": x, "y": y, "width": width - x, "height": height - y, "scale": 1},
+                    "captureBeyondViewport": True,
+                })
+                screenshot = base64.b64decode(result["data"])
+                span.set(bytes_count=len(screenshot))
+        except WebDriverException as error:
+            logging.info(f"Clipped capture is not supported, capture strips: {error}")
+            return None
+
+        logging.info(f"Clipped capture: ({x}, {y}, {width}, {height})")
+        self._record_frame(FrameSet.METHOD_SINGLE, screenshot)
+        return self.image_processor.load_image_from_bytes(screenshot)
+
+    def _paste_viewports(self, total_height, viewport_height, y) -> Image.Image:
+        """Снять страницу кадрами по высоте вьюпорта и склеить их через ImageProcessor.paste()."""
+        screenshots = []
+        offset = 0
         while offset <= total_height or offset <= y:
             logging.info(f"offset: {offset}, total height: {total_height}")
-            screenshots.append(self.driver.get_screenshot_as_png())
+            screenshots.append(self._take_screenshot())
+            self._record_frame(FrameSet.METHOD_PASTE, screenshots[-1])
             offset += viewport_height
             self._scroll(0, offset)
 
@@ -73,22 +255,40 @@ class TestCase(common.TestCase):
         # так просходит потому что не всегда страница делится на целое количество вьюпортов
         over_height = offset - total_height
         logging.info(f"offset: {offset}, total height: {total_height}, over height: {over_height}, pixel density: {self.pixel_ratio}")
+        if self._frames is not None:
+            self._frames.over_height = over_height * self.pixel_ratio
         return self.image_processor.paste(screenshots, over_height * self.pixel_ratio)
 
+    def _start_frames(self):
+        """Начать запись кадров нового снятия, если она включена."""
+        self._frames = None
+        if self.frame_recorder is not None:
+            self._frames = FrameSet(self.pixel_ratio, self.mask_fixed_elements)
+
+    def _record_frame(self, method: str, screenshot: bytes, shift: int = 0):
+        if self._frames is not None:
+            self._frames.add(method, screenshot, shift)
+
     def _use_full_screen(self):
         # хак чтобы снять целиком элемент который не помещается на страницу
         # https://stackoverflow.com/questions/44085722/how-to-get-screenshot-of-full-webpage-using-selenium-and-java
         # https://gist.github.com/elcamino/5f562564ecd2fb86f559
         self.driver.set_window_size(1425, 2900)
 
-    def _get_raw_coords_by_locator(self, locator_type, query_string):
-        """Без учета плотности пикселей."""
+    def _get_raw_coords_by_locator(self, locator_type, query_string, settle=True):
+        """Без учета плотности пикселей.
+
+        :param settle: дождаться, пока элемент перестанет двигаться. Можно выключить, если страница уже стабильна.
+        """
         wait = WebDriverWait(self.driver, timeout=10, ignored_exceptions=Exception)
         wait.until(lambda _: self.driver.find_element(locator_type, query_string).is_displayed(),
                    message="Невозможно получить размеры элемента, элемент не отображается")
-        # После того, как дождались видимости элемента, ждем еще 2 секунды, чтобы точно завершились разные анимации
-        time.sleep(2)
         el = self.driver.find_element(locator_type, query_string)
+        # После того, как дождались видимости элемента, ждем пока завершатся анимации и элемент перестанет двигаться
+        if settle:
+            self.settler.wait(self.driver, f"element «{query_string}» is displayed", element=el)
+            # За время ожидания элемент могли перерисовать, тогда старая ссылка на него уже не годится
+            el = self.driver.find_element(locator_type, query_string)
         location = el.location
         size = el.size
         x = location["x"]
@@ -98,8 +298,8 @@ class TestCase(common.TestCase):
         # (312, 691, 1112, 691)
         return x, y, width, height
 
-    def _get_coords_by_locator(self, locator_type, query_string) -> Tuple[int, int, int, int]:
-        x, y, width, height = self._get_raw_coords_by_locator(locator_type, query_string)
+    def _get_coords_by_locator(self, locator_type, query_string, settle=True) -> Tuple[int, int, int, int]:
+        x, y, width, height = self._get_raw_coords_by_locator(locator_type, query_string, settle)
         return x * self.pixel_ratio, y * self.pixel_ratio, width * self.pixel_ratio, height * self.pixel_ratio
 
     def _get_element_screenshot(
@@ -109,9 +309,11 @@ class TestCase(common.TestCase):
         action,
         finalize,
         scroll_and_screen
-    ) -> Tuple[Image.Image, Tuple[int, int, int, int]]:
+    ) -> Tuple[Image.Image, Tuple[int, int, int, int], Optional[FrameSet]]:
         """Сделать скриншот страницы и кропнуть до скриншота элемента.
 
+        Третьим значением возвращаются снятые кадры, если включена их запись, иначе None.
+
         Не получится использовать метод session/{sessionId}/element/{elementId}/screenshot
         Потому что он имплементирован только в эдж.
         https://stackoverflow.com/questions/36084257/im-trying-to-take-a-screenshot-of-an-element-with-selenium-webdriver-but-unsup
@@ -123,33 +325,153 @@ class TestCase(common.TestCase):
             self._scroll(0, 0)
 
         # Тут готовим страницу к снятию скриншота
-        if callable(action):
-            action()
+        self._call_hook(action)
+        self._start_frames()
+
+        if scroll_and_screen and self.element_capture != self.CAPTURE_PAGE and self.scroll_overlap:
+            # Снимаем только элемент, вырезать ничего не нужно
+            screen, coordinates = self._make_screenshot_element(locator_type, query_string)
+            logging.info(f"element: {query_string}, coordinates: {coordinates}")
+            self._call_hook(finalize)
+            return screen, coordinates, self._frames
 
         if scroll_and_screen:
             screen = self._make_screenshot_whole_page(locator_type, query_string)
         else:
-            screen = self.image_processor.load_image_from_bytes(self.driver.get_screenshot_as_png())
+            screenshot = self._take_screenshot()
+            self._record_frame(FrameSet.METHOD_SINGLE, screenshot)
+            screen = self.image_processor.load_image_from_bytes(screenshot)
 
         coordinates = self._get_coords_by_locator(locator_type, query_string)
         logging.info(f"element: {query_string}, coordinates: {coordinates}")
+        if self._frames is not None:
+            self._frames.crops = [coordinates]
 
         # Тут можно выполнить дополнительные проверки после снятия скрина
-        if callable(finalize):
-            finalize()
+        self._call_hook(finalize)
+
+        return screen.crop(coordinates), coordinates, self._frames
+
+    def _get_elements_screenshots(
+        self,
+        elements,
+        action,
+        finalize
+    ) -> Tuple[List[Tuple[Image.Image, Tuple[int, int, int, int]]], Optional[FrameSet]]:
+        """Снять страницу один раз и кропнуть из нее все элементы. Вторым значением возвращаются кадры, как в
+        _get_element_screenshot."""
+        self._call_hook(action)
+        self.settler.wait(self.driver, "action")
+        self._start_frames()
+
+        # страницу снимаем до самого нижнего элемента
+        lowest = max(elements, key=lambda element: self._get_raw_coords_by_locator(*element, settle=False)[3])
+        screen = self._make_screenshot_whole_page(*lowest)
+
+        result = []
+        for locator_type, query_string in elements:
+            coordinates = self._get_coords_by_locator(locator_type, query_string, settle=False)
+            logging.info(f"element: {query_string}, coordinates: {coordinates}")
+            result.append((screen.crop(coordinates), coordinates))
+        if self._frames is not None:
+            self._frames.crops = [coordinates for _, coordinates in result]
+
+        self._call_hook(finalize)
+        return result, self._frames
+
+    @staticmethod
+    def _hook_accepts_driver(hook) -> bool:
+        """action и finalize могут принимать драйвер стенда, на котором снимается скриншот."""
+        return callable(hook) and len(inspect.signature(hook).parameters) > 0
+
+    def _call_hook(self, hook):
+        if not callable(hook):
+            return
+        if self._hook_accepts_driver(hook):
+            hook(self.driver)
+        else:
+            hook()
+
+    def _can_capture_in_parallel(self, action, finalize) -> bool:
+        """Параллельно можно снимать, только если action и finalize не привязаны к self.driver."""
+        if self.staging_driver is None:
+            return False
+        for hook in (action, finalize):
+            if callable(hook) and not self._hook_accepts_driver(hook):
+                logging.info(f"{hook} doesn't accept driver, capture stands one by one")
+                return False
+        return True
+
+    def _on_driver(self, driver) -> "TestCase":
+        """Копия теста, в которой все методы снятия скриншотов работают с другим браузером."""
+        stand = copy.copy(self)
+        stand.driver = driver
+        return stand
+
+    def _capture_stands_in_parallel(self, prod_url, capture: Callable[["TestCase"], Any], full_screen: bool):
+        """Снять тестовый стенд в self.driver и эталонный в self.staging_driver одновременно.
+
+        Тестовый браузер никуда не уходит с текущей страницы, поэтому возвращаться на нее не нужно.
+        """
+        staging = self._on_driver(self.staging_driver)
+
+        def capture_staging():
+            if full_screen:
+                staging._use_full_screen()
+            staging._navigate(prod_url.geturl())
+            result = capture(staging)
+            logging.info('Done screen on stage stand')
+            return result
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            expected = executor.submit(capture_staging)
+            actual = capture(self)
+            logging.info('Done screen on test stand')
+            return actual, expected.result()
+
+    def _capture_stands(self, saved_url, prod_url, capture: Callable[["TestCase"], Any], action, finalize, full_screen):
+        """Снять тестовый и эталонный стенды, параллельно, если можно, вернуть (результат теста, результат эталона)."""
+        if self._can_capture_in_parallel(action, finalize):
+            return self._capture_stands_in_parallel(prod_url, capture, full_screen)
 
-        return screen.crop(coordinates), coordinates
+        # На текущей странице делаем первый скриншот
+        actual = capture(self)
+        logging.info('Done screen on test stand')
+        # Теперь делаем скриншот в проде
+        self._navigate(prod_url.geturl())
+        expected = capture(self)
+        logging.info('Done screen on stage stand')
 
-    def _get_diff(self, element=None, action=None, full_screen=True, full_page=False, finalize=None, scroll_and_screen=True):
+        # Возращаемся на тестовый стенд. Всегда нужно возвращаться на тестовый стенд. На это завязаны тесты и отчеты
+        self._navigate(saved_url.geturl())
+        return actual, expected
+
+    def _get_baseline_key(self, prod_url, locator) -> str:
+        """Ключ эталона в кэше: кроме страницы, локатора, размера окна и плотности пикселей учитываем тест и номер
+        проверки в нем, потому что action в разных проверках может по-разному менять страницу."""
+        size = self.driver.get_window_size()
+        return self.baseline_store.make_key(
+            prod_url.geturl(),
+            locator,
+            (size["width"], size["height"]),
+            self.pixel_ratio,
+            f"{self._test_id}#{self._checks_count}",
+        )
+
+    def _get_diff(self, element=None, action=None, full_screen=True, full_page=False, finalize=None, scroll_and_screen=True,
+                  comparison=None):
         """Получит скриншоты с текущей страницы, и с эталонной.
 
         Поблочно сравнит их, и вернет количество отличающихся блоков.
         :param element: tuple с типом локатора и локатором.
-        :param action: функция, которая подготовит страницу к снятию скриншота.
+        :param action: функция, которая подготовит страницу к снятию скриншота. Может принимать драйвер стенда, тогда
+            стенды снимаются параллельно (--parallel_stands).
         :param full_screen: resize ли браузер до максимума.
         :param full_page: скринить всю страницу, а не только переданный элемент.
-        :param finalize: финализация после сравнения скриншотов.
+        :param finalize: финализация после сравнения скриншотов. Может принимать драйвер стенда, как и action.
         :param scroll_and_screen: скролить страницу (сверху к низу) и склеивать участки в один скриншот.
+        :param comparison: сравнение пикселей для этой проверки вместо --comparison, например
+            ImageProcessor.COMPARISON_PERCEPTUAL для элементов с текстом, где мешает антиалиазинг шрифтов.
         """
         if full_screen:
             self._use_full_screen()
@@ -164,29 +486,93 @@ class TestCase(common.TestCase):
         # noinspection PyProtectedMember
         prod_url = saved_url._replace(netloc=self.staging)
 
-        # На текущей странице делаем первый скриншот
-        first_image, coords_test = self._get_element_screenshot(locator_type, query_string, action, finalize, scroll_and_screen)
-        logging.info('Done screen on test stand')
-        # Теперь делаем скриншот в проде
-        self.driver.get(prod_url.geturl())
-        second_image, coords_prod = self._get_element_screenshot(locator_type, query_string, action, finalize, scroll_and_screen)
-        logging.info('Done screen on stage stand')
+        def capture(stand: TestCase):
+            return stand._get_element_screenshot(locator_type, query_string, action, finalize, scroll_and_screen)
+
+        self._checks_count += 1
+        baseline_key = baseline = second_digests = None
+        if self.baseline_store is not None:
+            baseline_key = self._get_baseline_key(
+                prod_url, (locator_type, query_string, scroll_and_screen, self.element_capture)
+            )
+            baseline = self.baseline_store.get(baseline_key)
+
+        if baseline is not None:
+            # Эталон уже есть в кэше, стейджинг не трогаем
+            first_image, coords_test, first_frames = capture(self)
+            logging.info('Done screen on test stand, stage screen is taken from cache')
+            second_image, second_digests = baseline
+            second_frames = None
+        else:
+            (first_image, coords_test, first_frames), (second_image, coords_prod, second_frames) = \
+                self._capture_stands(saved_url, prod_url, capture, action, finalize, full_screen)
 
-        # Возращаемся на тестовый стенд. Всегда нужно возвращаться на тестовый стенд. На это завязаны тесты и отчеты
-        self.driver.get(saved_url.geturl())
+        if baseline_key is not None and baseline is None:
+            second_digests = self.image_processor.band_digests(second_image)
+            self.baseline_store.put(baseline_key, second_image, second_digests)
 
         # Для добавления в отчет (https://github.com/allure-framework/allure2/tree/master/plugins/screen-diff-plugin)
-        # noinspection PyUnboundLocalVariable
-        allure.attach(self.image_processor.image_to_bytes(first_image), 'actual', allure.attachment_type.PNG)
-        # noinspection PyUnboundLocalVariable
-        allure.attach(self.image_processor.image_to_bytes(second_image), 'expected', allure.attachment_type.PNG)
-
-        # noinspection PyUnboundLocalVariable
-        diff, result = self.image_processor.get_images_diff(first_image, second_image)
-        allure.attach(result, 'diff', allure.attachment_type.PNG)
-
+        # Картинки кодируются в фоне и прикрепляются к отчету после теста, см. AttachmentWriter
+        if not self.skip_clean_attachments:
+            self._attach_screenshots(first_image, second_image)
+
+        diff, regions = self.image_processor.get_diff_regions(
+            first_image, second_image, second_digests, comparison
+        )
+        if self.skip_clean_attachments and diff:
+            self._attach_screenshots(first_image, second_image)
+        # Если отличий нет, картинки с диффом не строятся
+        if diff:
+            self._attach_diff(first_image, second_image, regions)
+
+        if first_frames is not None:
+            self._record_check(
+                first_frames, second_frames or FrameSet.from_images([second_image], self.pixel_ratio),
+                [(locator_type, query_string)], [diff], comparison,
+            )
         return diff, saved_url, prod_url
 
+    def _record_check(self, actual: FrameSet, expected: FrameSet, elements, diffs: List[int], comparison):
+        """Сохранить кадры проверки и все, что нужно, чтобы повторить ее сравнение без браузера."""
+        self.frame_recorder.save(self._test_id, self._checks_count, actual, expected, {
+            "elements": [list(element) for element in elements],
+            "diffs": diffs,
+            "settings": self.image_processor.settings(comparison),
+        })
+
+    def _attach_screenshots(self, first_image: Image.Image, second_image: Image.Image, step: Optional[str] = None):
+        """Вложения называются всегда actual и expected, как ждет screen-diff-plugin. Элементы одной проверки
+        разделяются шагами allure (step)."""
+        self.attachment_writer.attach_image(first_image, 'actual', step)
+        self.attachment_writer.attach_image(second_image, 'expected', step)
+
+    def _attach_diff(self, first_image: Image.Image, second_image: Image.Image, regions, step: Optional[str] = None):
+        """Приложить к отчету дифф всей страницы, кропы самых больших областей отличий и их описание.
+
+        Дифф всей страницы в полном размере прикладывается с --full_diff или если размеры скриншотов разные (блоки,
+        которые есть только на одном из скриншотов, в области не попадают), иначе уменьшенный до diff_preview_pixels.
+        """
+        logging.info(f"Diff regions: {len(regions)}, " + ", ".join(
+            f"{region.box} ({len(region.blocks)} blocks, max delta {region.max_delta})" for region in regions
+        ))
+        if self.full_diff or first_image.size != second_image.size:
+            diff_image = self.image_processor.draw_diff(first_image, regions)
+        else:
+            diff_image = self.image_processor.draw_diff_preview(first_image, regions, self.diff_preview_pixels)
+        self.attachment_writer.attach_image(diff_image, 'diff', step)
+
+        largest = sorted(range(len(regions)), key=lambda index: regions[index].area, reverse=True)
+        largest = set(largest[:self.diff_regions_limit])
+        for index, region in enumerate(regions):
+            if index in largest:
+                self.attachment_writer.attach_image(
+                    self.image_processor.draw_region(first_image, region), f'diff region {index + 1}', step
+                )
+        self.attachment_writer.attach_json([
+            {"box": region.box, "blocks": len(region.blocks), "area": region.area, "max_delta": region.max_delta}
+            for region in regions
+        ], 'diff regions', step)
+
     def get_diff(self, *args, **kwargs):
         diff, _, _ = self._get_diff(*args, **kwargs)
         return diff
@@ -194,3 +580,91 @@ class TestCase(common.TestCase):
     def check_by_screenshot(self, element, *args, **kwargs):
         diff, saved_url, prod_url = self._get_diff(element, *args, **kwargs)
         assert diff == 0, f"Элемент отличается на страницах:\n{saved_url.geturl()}\nи\n{prod_url.geturl()}"
+
+    def _get_diffs(self, elements, action=None, full_screen=True, finalize=None, comparison=None):
+        """Как _get_diff, но для нескольких элементов одной страницы.
+
+        Каждый стенд открывается и снимается один раз, все элементы вырезаются из этого снимка и сравниваются одним
+        вызовом ImageProcessor.get_batch_diff_regions. action и finalize общие для всех элементов.
+        :param elements: список tuple с типом локатора и локатором.
+        """
+        assert elements, "Нужен хотя бы один элемент"
+        elements = [(element[0], element[1]) for element in elements]
+        if full_screen:
+            self._use_full_screen()
+
+        saved_url = urlparse(self.driver.current_url)
+        # noinspection PyProtectedMember
+        prod_url = saved_url._replace(netloc=self.staging)
+
+        def capture(stand: TestCase):
+            return stand._get_elements_screenshots(elements, action, finalize)
+
+        self._checks_count += 1
+        baseline_keys = baselines = None
+        if self.baseline_store is not None:
+            baseline_keys = [
+                self._get_baseline_key(prod_url, ("batch", index, *element, self.element_capture))
+                for index, element in enumerate(elements)
+            ]
+            baselines = [self.baseline_store.get(key) for key in baseline_keys]
+
+        if baselines is not None and all(baseline is not None for baseline in baselines):
+            # Все эталоны уже есть в кэше, стейджинг не трогаем
+            actual, actual_frames = capture(self)
+            logging.info('Done screen on test stand, stage screens are taken from cache')
+            expected = [baseline.image for baseline in baselines]
+            digests = [baseline.digests for baseline in baselines]
+            expected_frames = None
+        else:
+            (actual, actual_frames), (expected, expected_frames) = self._capture_stands(
+                saved_url, prod_url, capture, action, finalize, full_screen
+            )
+            expected = [image for image, _ in expected]
+            digests = [self.image_processor.band_digests(image) for image in expected] if baseline_keys else \
+                [None] * len(elements)
+            for key, image, image_digests in zip(baseline_keys or [], expected, digests):
+                self.baseline_store.put(key, image, image_digests)
+        actual = [image for image, _ in actual]
+
+        # у каждого элемента свой шаг allure со своими actual, expected и diff
+        steps = [f"Element {query_string}" for _, query_string in elements]
+        if not self.skip_clean_attachments:
+            for first_image, second_image, step in zip(actual, expected, steps):
+                self._attach_screenshots(first_image, second_image, step)
+
+        results = self.image_processor.get_batch_diff_regions(list(zip(actual, expected, digests)), comparison)
+
+        element_diffs = []
+        for element, first_image, second_image, step, (diff, regions) in zip(
+            elements, actual, expected, steps, results
+        ):
+            logging.info(f"element: {element[1]}, diff: {diff}")
+            if self.skip_clean_attachments and diff:
+                self._attach_screenshots(first_image, second_image, step)
+            if diff:
+                self._attach_diff(first_image, second_image, regions, step)
+            element_diffs.append(ElementDiff(element, diff, regions))
+
+        self.attachment_writer.attach_json(
+            [{"element": list(result.element), "diff": result.diff, "regions": len(result.regions)}
+             for result in element_diffs],
+            'elements'
+        )
+        if actual_frames is not None:
+            self._record_check(
+                actual_frames, expected_frames or FrameSet.from_images(expected, self.pixel_ratio),
+                elements, [result.diff for result in element_diffs], comparison,
+            )
+        return element_diffs, saved_url, prod_url
+
+    def get_diffs(self, *args, **kwargs) -> List["ElementDiff"]:
+        element_diffs, _, _ = self._get_diffs(*args, **kwargs)
+        return element_diffs
+
+    def check_by_screenshots(self, elements, *args, **kwargs):
+        """Проверить несколько элементов страницы за одно снятие каждого стенда."""
+        element_diffs, saved_url, prod_url = self._get_diffs(elements, *args, **kwargs)
+        failed = [f"{result.element[1]}: {result.diff}" for result in element_diffs if result.diff]
+        assert not failed, f"Элементы отличаются на страницах:\n{saved_url.geturl()}\nи\n{prod_url.geturl()}\n" + \
+            "\n".join(failed)
@@ -0,0 +1,156 @@
+"""Ожидание стабильности страницы вместо фиксированных time.sleep."""
+
+import hashlib
+import logging
+import time
+from typing import List, NamedTuple, Optional
+
+from selenium.common.exceptions import StaleElementReferenceException
+from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.remote.webelement import WebElement
+
+from screenshot_tests.image_proccessing.image_processor import ImageProcessor
+from screenshot_tests.utils.timing import timings
+
+# Состояние страницы, по которому судим о стабильности. Бесконечные анимации (спиннеры и т.п.) не учитываются,
+# иначе страница никогда не станет стабильной. Незагруженные картинки считаются только во вьюпорте, потому что
+# картинки с loading=lazy за его пределами не загрузятся, пока до них не доскролят.
+PAGE_STATE_SCRIPT = """
+const element = arguments[0];
+const inViewport = (img) => {
+    const rect = img.getBoundingClientRect();
+    return rect.bottom > 0 && rect.top < window.innerHeight;
+};
+const animations = document.getAnimations ? document.getAnimations().filter(
+    (animation) => animation.playState === 'running' && animation.effect
+        && isFinite(animation.effect.getComputedTiming().endTime)
+).length : 0;
+const rect = element ? element.getBoundingClientRect() : null;
+return {
+    readyState: document.readyState,
+    scrollHeight: document.documentElement.scrollHeight,
+    scrollY: window.pageYOffset,
+    pendingImages: Array.from(document.images).filter((img) => !img.complete && inViewport(img)).length,
+    animations: animations,
+    element: rect ? [rect.x, rect.y, rect.width, rect.height] : null,
+};
+"""
+
+
+class SettleWait(NamedTuple):
+    """Одно ожидание стабильности страницы"""
+    reason: str
+    elapsed: float
+    settled: bool
+
+
+class PageSettler(object):
+    """Опрашивает страницу, пока она не станет стабильной, или пока не выйдет таймаут.
+
+    Страница стабильна, если документ загружен, во вьюпорте нет загружающихся картинок, нет конечных анимаций и
+    переходов, а высота страницы, прокрутка и положение элемента (если передан) не менялись stable_time секунд.
+    При compare_frames дополнительно сравниваются уменьшенные скриншоты вьюпорта, это дороже, но ловит анимации,
+    которые не видны через document.getAnimations() (canvas, js).
+    """
+
+    def __init__(
+        self,
+        timeout: float = 2.0,
+        poll_interval: float = 0.05,
+        stable_time: float = 0.1,
+        compare_frames: bool = False
+    ):
+        """
+        :param timeout: максимальное время ожидания по умолчанию, в секундах.
+        :param poll_interval: интервал опроса страницы.
+        :param stable_time: сколько времени состояние страницы должно не меняться.
+        :param compare_frames: сравнивать уменьшенные скриншоты вьюпорта.
+        """
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.stable_time = stable_time
+        self.compare_frames = compare_frames
+        self.waits: List[SettleWait] = []
+
+    @staticmethod
+    def _frame_hash(driver: WebDriver) -> str:
+        image = ImageProcessor.load_image_from_bytes(driver.get_screenshot_as_png())
+        small = image.convert("RGB").reduce(8)
+        return hashlib.blake2b(small.tobytes(), digest_size=16).hexdigest()
+
+    # Положение элемента, который перерисовали и который больше не в документе
+    STALE_ELEMENT = "stale"
+
+    def _state(self, driver: WebDriver, element: Optional[WebElement]) -> dict:
+        try:
+            state = driver.execute_script(PAGE_STATE_SCRIPT, element)
+        except StaleElementReferenceException:
+            # Элемент перерисовали: это изменение состояния, дальше ждем стабильности страницы без него
+            state = driver.execute_script(PAGE_STATE_SCRIPT, None)
+            state["element"] = self.STALE_ELEMENT
+        if self.compare_frames:
+            state["frame"] = self._frame_hash(driver)
+        return state
+
+    @staticmethod
+    def _is_idle(state: dict) -> bool:
+        return state["readyState"] == "complete" and state["pendingImages"] == 0 and state["animations"] == 0
+
+    def wait(
+        self,
+        driver: WebDriver,
+        reason: str,
+        timeout: Optional[float] = None,
+        stable_time: Optional[float] = None,
+        element: Optional[WebElement] = None
+    ) -> float:
+        """Дождаться стабильности страницы, вернуть сколько времени заняло ожидание.
+
+        По таймауту исключение не бросается, как и раньше с time.sleep: скриншот снимается в любом случае.
+        :param driver: вебдрайвер.
+        :param reason: после чего ждем, для логов.
+        :param timeout: таймаут вместо self.timeout.
+        :param stable_time: время стабильности вместо self.stable_time.
+        :param element: дополнительно ждать, пока элемент не перестанет двигаться. Элемент могут перерисовать во
+            время ожидания, поэтому после него элемент нужно искать заново.
+        """
+        with timings.span("settle"):
+            return self._wait(driver, reason, timeout, stable_time, element)
+
+    def _wait(
+        self,
+        driver: WebDriver,
+        reason: str,
+        timeout: Optional[float],
+        stable_time: Optional[float],
+        element: Optional[WebElement]
+    ) -> float:
+        timeout = self.timeout if timeout is None else timeout
+        stable_time = self.stable_time if stable_time is None else stable_time
+
+        started = time.perf_counter()
+        previous = None
+        stable_since = None
+        settled = False
+        while True:
+            state = self._state(driver, element)
+            now = time.perf_counter()
+            # отсчет стабильности начинается заново при любом изменении состояния
+            if state != previous or not self._is_idle(state):
+                stable_since = now
+            elif now - stable_since >= stable_time:
+                settled = True
+                break
+
+            if now - started >= timeout:
+                break
+            previous = state
+            time.sleep(self.poll_interval)
+
+        elapsed = time.perf_counter() - started
+        self.waits.append(SettleWait(reason, elapsed, settled))
+        if settled:
+            logging.info(f"Page settled after {reason} in {elapsed:.3f}s")
+        else:
+            logging.info(f"Page is not settled after {reason} in {elapsed:.3f}s, last state: {state}")
+        return elapsed
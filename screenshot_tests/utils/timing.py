@@ -0,0 +1,171 @@
+"""Замеры времени этапов проверки: навигация, ожидания, снятие, декодирование, склейка, сравнение, кодирование."""
+
+import cProfile
+import json
+import logging
+import pstats
+import threading
+import time
+from collections import defaultdict
+from io import StringIO
+from typing import Dict, List, NamedTuple, Optional
+
+
+class Span(NamedTuple):
+    """Один замер"""
+    name: str
+    elapsed: float
+    # сколько байт и пикселей обработано (png, картинка), 0 если неприменимо
+    bytes: int
+    pixels: int
+
+
+class _ActiveSpan(object):
+    """Замер, который идет сейчас. bytes и pixels часто известны только в конце, их можно дописать через set()."""
+
+    __slots__ = ("_timings", "_name", "_started", "_bytes", "_pixels")
+
+    def __init__(self, timings: "Timings", name: str, bytes_count: int, pixels: int):
+        self._timings = timings
+        self._name = name
+        self._bytes = bytes_count
+        self._pixels = pixels
+        self._started = 0.0
+
+    def set(self, bytes_count: Optional[int] = None, pixels: Optional[int] = None):
+        if bytes_count is not None:
+            self._bytes = bytes_count
+        if pixels is not None:
+            self._pixels = pixels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._timings.add(Span(self._name, time.perf_counter() - self._started, self._bytes, self._pixels))
+
+
+class _NullSpan(object):
+    """Замер при выключенных замерах: ничего не делает."""
+
+    __slots__ = ()
+
+    def set(self, bytes_count: Optional[int] = None, pixels: Optional[int] = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Timings(object):
+    """Копит замеры за тест и за сессию.
+
+    По умолчанию выключен, тогда span() возвращает общий пустой контекстный менеджер и замер стоит один вызов функции.
+    Замеры можно добавлять из любого потока (склейка и кодирование вложений идут в фоне).
+
+        with timings.span("capture") as span:
+            png = driver.get_screenshot_as_png()
+            span.set(bytes_count=len(png))
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # cProfile для сравнения изображений, см. profile()
+        self.profiler: Optional[cProfile.Profile] = None
+        self._lock = threading.Lock()
+        self._session: List[Span] = []
+        self._test: List[Span] = []
+        self._tests: Dict[str, dict] = {}
+
+    def span(self, name: str, bytes_count: int = 0, pixels: int = 0):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _ActiveSpan(self, name, bytes_count, pixels)
+
+    def add(self, span: Span):
+        with self._lock:
+            self._session.append(span)
+            self._test.append(span)
+
+    def begin_test(self):
+        with self._lock:
+            self._test = []
+
+    def end_test(self, test_id: str) -> dict:
+        """Сводка по замерам теста, она же сохраняется для итогового отчета"""
+        with self._lock:
+            spans, self._test = self._test, []
+        summary = self.summarize(spans)
+        self._tests[test_id] = summary
+        return summary
+
+    @staticmethod
+    def summarize(spans: List[Span]) -> dict:
+        """Сводка по этапам: количество, суммарное и максимальное время, байты и пиксели"""
+        summary = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0, "bytes": 0, "pixels": 0})
+        for span in spans:
+            item = summary[span.name]
+            item["count"] += 1
+            item["total"] += span.elapsed
+            item["max"] = max(item["max"], span.elapsed)
+            item["bytes"] += span.bytes
+            item["pixels"] += span.pixels
+        return dict(sorted(summary.items(), key=lambda pair: pair[1]["total"], reverse=True))
+
+    def report(self) -> dict:
+        with self._lock:
+            spans = list(self._session)
+        return {"session": self.summarize(spans), "tests": self._tests}
+
+    def save(self, path: str):
+        with open(path, "w") as fp:
+            json.dump(self.report(), fp, indent=2)
+        logging.info(f"Timings are saved to {path}")
+
+    @staticmethod
+    def format(summary: dict) -> str:
+        return "\n".join(
+            f"{name}: {item['count']} x, {item['total']:.3f}s (max {item['max']:.3f}s), "
+            f"{item['bytes']} bytes, {item['pixels']} pixels"
+            for name, item in summary.items()
+        )
+
+    def profile(self):
+        """Контекстный менеджер, под которым работает cProfile, если он включен (profiler не None).
+
+        Профилируется только поток, который вызвал profile(); потоки пула сравнения видны как ожидание результата.
+        """
+        if self.profiler is None:
+            return _NULL_SPAN
+        return _Profiled(self.profiler)
+
+    def profile_report(self, limit: int = 30) -> str:
+        with StringIO() as stream:
+            pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(limit)
+            return stream.getvalue()
+
+
+class _Profiled(object):
+
+    __slots__ = ("_profiler",)
+
+    def __init__(self, profiler: cProfile.Profile):
+        self._profiler = profiler
+
+    def __enter__(self):
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._profiler.disable()
+
+
+# Общие замеры процесса, включаются в conftest.py (--timings)
+timings = Timings()